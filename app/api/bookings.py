@@ -1,33 +1,94 @@
 
 # app/api/bookings.py
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException, Query
+from sqlalchemy import and_, or_
 from sqlalchemy.orm import Session
-from app.database import get_db
+from app.database import get_db, SessionLocal
 from app.schemas import Booking
-from app.models import BookingCreate, BookingResponse
+from app.models import BookingCreate, BookingResponse, BookingPage
 
 # Google Calendar imports
 import os
-from datetime import datetime, timedelta
+import base64
+import hashlib
+import threading
+from datetime import date, datetime, timedelta
+from typing import Optional
 from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
 from google.oauth2.service_account import Credentials
 
-router = APIRouter(prefix="/api/bookings", tags=["Bookings"])
+# Mounted under /api/bookings by app.main
+router = APIRouter()
 
 # Google Calendar helpers
 GOOGLE_CALENDAR_ID = os.getenv("GOOGLE_CALENDAR_ID", "")
 GOOGLE_APPLICATION_CREDENTIALS = os.getenv("GOOGLE_APPLICATION_CREDENTIALS", "")
 GOOGLE_CALENDAR_TIMEZONE = os.getenv("GOOGLE_CALENDAR_TIMEZONE", "Africa/Nairobi")
+# Google accepts at most 50 calls per batch request
+CALENDAR_BATCH_SIZE = min(50, int(os.getenv("GOOGLE_CALENDAR_BATCH_SIZE", "50")))
 
 SCOPES = ["https://www.googleapis.com/auth/calendar"]
 
+_credentials: Optional[Credentials] = None
+_credentials_lock = threading.Lock()
+# googleapiclient services share an httplib2 connection that is not
+# thread-safe, so each worker thread keeps its own (built once, then reused)
+_calendar_local = threading.local()
+
+
+def _get_credentials() -> Credentials:
+    global _credentials
+    if _credentials is None:
+        with _credentials_lock:
+            if _credentials is None:
+                if not GOOGLE_APPLICATION_CREDENTIALS or not os.path.exists(GOOGLE_APPLICATION_CREDENTIALS):
+                    raise RuntimeError("Google credentials not configured. Set GOOGLE_APPLICATION_CREDENTIALS to your service account JSON path.")
+                _credentials = Credentials.from_service_account_file(GOOGLE_APPLICATION_CREDENTIALS, scopes=SCOPES)
+    return _credentials
+
+
 def _get_calendar_service():
-    if not GOOGLE_APPLICATION_CREDENTIALS or not os.path.exists(GOOGLE_APPLICATION_CREDENTIALS):
-        raise RuntimeError("Google credentials not configured. Set GOOGLE_APPLICATION_CREDENTIALS to your service account JSON path.")
     if not GOOGLE_CALENDAR_ID:
         raise RuntimeError("Google Calendar ID not set. Set GOOGLE_CALENDAR_ID.")
-    creds = Credentials.from_service_account_file(GOOGLE_APPLICATION_CREDENTIALS, scopes=SCOPES)
-    return build("calendar", "v3", credentials=creds, cache_discovery=False)
+    service = getattr(_calendar_local, "service", None)
+    if service is None:
+        service = build("calendar", "v3", credentials=_get_credentials(), cache_discovery=False)
+        _calendar_local.service = service
+    return service
+
+def event_id_for_booking(booking: Booking) -> str:
+    """
+    Calendar event id for a booking row (Google allows base32hex: a-v and
+    0-9). It hashes the id with created_at, so a reused rowid, a recreated
+    database or another environment on the same calendar gets a different
+    id, while concurrent or repeated inserts for one row hit 409 instead of
+    creating a second event.
+    """
+    created_at = booking.created_at.isoformat() if booking.created_at else ""
+    digest = hashlib.sha256(f"{booking.id}|{created_at}".encode()).hexdigest()[:16]
+    return f"booking{booking.id:06d}{digest}"
+
+
+def _is_duplicate(error: Exception) -> bool:
+    return isinstance(error, HttpError) and error.resp.status == 409
+
+
+def _existing_event(service, booking: Booking, event_body: dict) -> str:
+    """
+    Resolve a 409 on insert: return the event if it is this booking's,
+    restoring it if it was deleted (Google never frees a deleted event's id).
+    """
+    event = service.events().get(calendarId=GOOGLE_CALENDAR_ID, eventId=event_body["id"]).execute()
+    owner = event.get("extendedProperties", {}).get("private", {}).get("booking_id")
+    if owner != str(booking.id):
+        raise RuntimeError(f"Calendar event {event_body['id']} belongs to another booking")
+    if event.get("status") == "cancelled":
+        event = service.events().update(
+            calendarId=GOOGLE_CALENDAR_ID, eventId=event_body["id"], body={**event_body, "status": "confirmed"},
+        ).execute()
+    return event.get("id")
+
 
 def _booking_to_event_payload(booking: Booking) -> dict:
     # Combine booking date and time into start datetime; assume 1-hour duration
@@ -35,21 +96,92 @@ def _booking_to_event_payload(booking: Booking) -> dict:
     end_dt = start_dt + timedelta(hours=1)
     description = f"Service: {booking.service_name}\nCustomer: {booking.customer_name}\nPhone: {booking.phone_number}\nAmount: KES {booking.amount}\nStatus: {booking.status}"
     return {
+        "id": event_id_for_booking(booking),
         "summary": f"Glow Haven: {booking.service_name} ({booking.customer_name})",
         "description": description,
         "start": {"dateTime": start_dt.isoformat(), "timeZone": GOOGLE_CALENDAR_TIMEZONE},
         "end": {"dateTime": end_dt.isoformat(), "timeZone": GOOGLE_CALENDAR_TIMEZONE},
+        "extendedProperties": {"private": {"booking_id": str(booking.id)}},
     }
 
 def create_calendar_event_for_booking(booking: Booking) -> str:
     """Create a Google Calendar event for the given booking, return eventId."""
     service = _get_calendar_service()
     event_body = _booking_to_event_payload(booking)
-    event = service.events().insert(calendarId=GOOGLE_CALENDAR_ID, body=event_body).execute()
+    try:
+        event = service.events().insert(calendarId=GOOGLE_CALENDAR_ID, body=event_body).execute()
+    except HttpError as e:
+        if not _is_duplicate(e):
+            raise
+        # Created by a concurrent link or sync, or deleted since
+        return _existing_event(service, booking, event_body)
     return event.get("id")
 
+
+def create_calendar_events_batched(bookings: list[Booking]) -> tuple[dict[int, str], dict[int, str]]:
+    """
+    Insert events for `bookings` using batch requests of up to
+    CALENDAR_BATCH_SIZE calls each. Blocking; run it in a worker thread.
+    Returns ({booking_id: event_id}, {booking_id: error}); events that
+    already existed for the booking count as created.
+    """
+    service = _get_calendar_service()
+    created: dict[int, str] = {}
+    failed: dict[int, str] = {}
+    conflicts: list[int] = []
+
+    def on_response(request_id, response, exception):
+        if _is_duplicate(exception):
+            conflicts.append(int(request_id))
+        elif exception is not None:
+            reason = exception.reason if isinstance(exception, HttpError) else str(exception)
+            failed[int(request_id)] = reason
+        else:
+            created[int(request_id)] = response.get("id")
+
+    for start in range(0, len(bookings), CALENDAR_BATCH_SIZE):
+        batch = service.new_batch_http_request(callback=on_response)
+        for booking in bookings[start:start + CALENDAR_BATCH_SIZE]:
+            batch.add(
+                service.events().insert(calendarId=GOOGLE_CALENDAR_ID, body=_booking_to_event_payload(booking)),
+                request_id=str(booking.id),
+            )
+        try:
+            batch.execute()
+        except Exception as e:
+            # The whole round trip failed; none of this batch's events exist
+            for booking in bookings[start:start + CALENDAR_BATCH_SIZE]:
+                if booking.id not in created:
+                    failed.setdefault(booking.id, str(e))
+
+    # Rare (concurrent link, or an event deleted in Google): check each one
+    by_id = {booking.id: booking for booking in bookings}
+    for booking_id in conflicts:
+        booking = by_id[booking_id]
+        try:
+            created[booking_id] = _existing_event(service, booking, _booking_to_event_payload(booking))
+        except Exception as e:
+            failed[booking_id] = e.reason if isinstance(e, HttpError) else str(e)
+    return created, failed
+
+
+def _link_calendar_event(booking_id: int):
+    """Background task: create the calendar event for a new booking."""
+    db = SessionLocal()
+    try:
+        booking = db.get(Booking, booking_id)
+        if booking is None or booking.calendar_event_id:
+            return
+        booking.calendar_event_id = create_calendar_event_for_booking(booking)
+        db.commit()
+    except Exception:
+        # Fail open: bookings missing an event are picked up by /sync_calendar
+        pass
+    finally:
+        db.close()
+
 @router.post("/create", response_model=BookingResponse)
-def create_booking(booking: BookingCreate, db: Session = Depends(get_db)):
+def create_booking(booking: BookingCreate, background_tasks: BackgroundTasks, db: Session = Depends(get_db)):
     new_booking = Booking(
         customer_name=booking.customer_name,
         phone_number=booking.phone_number,
@@ -63,39 +195,91 @@ def create_booking(booking: BookingCreate, db: Session = Depends(get_db)):
     db.commit()
     db.refresh(new_booking)
 
-    # Create Google Calendar event if not already linked
+    # Create the Google Calendar event after responding; booking creation
+    # should not wait on (or fail due to) the calendar
+    if GOOGLE_CALENDAR_ID and GOOGLE_APPLICATION_CREDENTIALS:
+        background_tasks.add_task(_link_calendar_event, new_booking.id)
+
+    return new_booking
+
+
+def _encode_cursor(booking: Booking) -> str:
+    raw = f"{booking.created_at.isoformat()}|{booking.id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def _decode_cursor(cursor: str) -> tuple[datetime, int]:
     try:
-        if not new_booking.id:
-            event_id = create_calendar_event_for_booking(new_booking)
-            new_booking.id = event_id
-            db.commit()
-            db.refresh(new_booking)
+        created_at, booking_id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+        return datetime.fromisoformat(created_at), int(booking_id)
     except Exception:
-        # Fail open: booking creation should not fail due to calendar issues
-        pass
+        raise HTTPException(status_code=400, detail="Invalid cursor")
 
-    return new_booking
 
+@router.get("/list", response_model=BookingPage)
+def list_bookings(
+    phone_number: Optional[str] = None,
+    status: Optional[str] = None,
+    date_from: Optional[date] = None,
+    date_to: Optional[date] = None,
+    limit: int = Query(50, ge=1, le=200),
+    cursor: Optional[str] = None,
+    db: Session = Depends(get_db),
+):
+    """
+    Bookings newest first, filtered server-side and paginated by keyset:
+    pass `next_cursor` from one page as `cursor` to get the next.
+    """
+    query = db.query(Booking)
+    if phone_number:
+        query = query.filter(Booking.phone_number == phone_number)
+    if status:
+        query = query.filter(Booking.status == status)
+    if date_from:
+        query = query.filter(Booking.date >= date_from)
+    if date_to:
+        query = query.filter(Booking.date <= date_to)
+    if cursor:
+        created_at, booking_id = _decode_cursor(cursor)
+        query = query.filter(or_(
+            Booking.created_at < created_at,
+            and_(Booking.created_at == created_at, Booking.id < booking_id),
+        ))
 
-@router.get("/list", response_model=list[BookingResponse])
-def list_bookings(db: Session = Depends(get_db)):
-    return db.query(Booking).order_by(Booking.created_at.desc()).all()
+    rows = query.order_by(Booking.created_at.desc(), Booking.id.desc()).limit(limit + 1).all()
+    items = rows[:limit]
+    next_cursor = _encode_cursor(items[-1]) if len(rows) > limit else None
+    return {"items": items, "next_cursor": next_cursor}
 
 @router.post("/sync_calendar")
-def sync_calendar(db: Session = Depends(get_db)):
-    """Create calendar events for bookings missing calendar_event_id."""
-    missing = db.query(Booking).filter(Booking.id.is_(None)).all()
-    created = 0
-    errors = 0
+def sync_calendar(limit: int = Query(500, ge=1, le=5000), db: Session = Depends(get_db)):
+    """
+    Create calendar events for bookings missing calendar_event_id, batched
+    into one request per CALENDAR_BATCH_SIZE bookings. Runs in FastAPI's
+    threadpool, off the event loop.
+    """
+    missing = (
+        db.query(Booking)
+        .filter(Booking.calendar_event_id.is_(None))
+        .order_by(Booking.id)
+        .limit(limit)
+        .all()
+    )
+    if not missing:
+        return {"created": 0, "errors": 0, "failed": []}
+    try:
+        created, failed = create_calendar_events_batched(missing)
+    except RuntimeError as e:
+        raise HTTPException(status_code=503, detail=str(e))
     for b in missing:
-        try:
-            event_id = create_calendar_event_for_booking(b)
-            b.calendar_event_id = event_id
-            created += 1
-        except Exception:
-            errors += 1
+        if b.id in created:
+            b.calendar_event_id = created[b.id]
     db.commit()
-    return {"created": created, "errors": errors}
+    return {
+        "created": len(created),
+        "errors": len(failed),
+        "failed": [{"booking_id": booking_id, "error": error} for booking_id, error in failed.items()],
+    }
 
 
 @router.get("/{booking_id}", response_model=BookingResponse)
@@ -1,21 +1,27 @@
 
 # app/api/payments.py
-from fastapi import APIRouter, Depends, HTTPException, Request
-from sqlalchemy.orm import Session
-from app.database import get_db
+import json
+from fastapi import APIRouter, Depends, HTTPException, Query, Request
+from fastapi.responses import StreamingResponse
+from sqlalchemy import select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.database import get_async_db, AsyncSessionLocal
 from app.schemas import Payment, Booking
 from app.models import PaymentCreate, PaymentResponse
 from app.utils.mpesa import initiate_stk_push
+from app.payment_events import PAYMENT_EVENTS, FINAL_STATUSES
 from datetime import datetime
-from app.utils.pdf_generator import generate_receipt_pdf
+from app.utils.pdf_generator import RECEIPT_RENDERER, receipt_fields
+from app.utils.signed_urls import receipt_url
 from whatsapp.client import send_whatsapp_message
 import os
 
-router = APIRouter(prefix="/api/payments", tags=["Payments"])
+# Mounted under /api/payments by app.main
+router = APIRouter()
 
 @router.post("/stkpush", response_model=PaymentResponse)
-async def stk_push(payment_data: PaymentCreate, db: Session = Depends(get_db)):
-    booking = db.query(Booking).filter(Booking.id == payment_data.booking_id).first()
+async def stk_push(payment_data: PaymentCreate, db: AsyncSession = Depends(get_async_db)):
+    booking = await db.get(Booking, payment_data.booking_id)
     if not booking:
         raise HTTPException(status_code=404, detail="Booking not found")
 
@@ -26,33 +32,37 @@ async def stk_push(payment_data: PaymentCreate, db: Session = Depends(get_db)):
         status="initiated"
     )
     db.add(payment)
-    db.commit()
-    db.refresh(payment)
+    await db.commit()
+    await db.refresh(payment)
 
     # trigger STK push via Daraja API
     stk_response = await initiate_stk_push(payment)
 
     if stk_response.get("ResponseCode") == "0":
         payment.status = "pending"
+        payment.checkout_request_id = stk_response.get("CheckoutRequestID")
     else:
         payment.status = "failed"
 
-    db.commit()
-    db.refresh(payment)
+    await db.commit()
+    await db.refresh(payment)
     return payment
 
 
-@router.get("/status/{booking_id}")
-def payment_status(booking_id: int, db: Session = Depends(get_db)):
-    payment = (
-        db.query(Payment)
+# Upper bound for long-poll and SSE waits
+MAX_STATUS_WAIT = float(os.getenv("PAYMENT_STATUS_MAX_WAIT", "60"))
+
+
+async def _status_payload(db: AsyncSession, booking_id: int) -> dict:
+    payment = (await db.execute(
+        select(Payment)
         .filter(Payment.booking_id == booking_id)
         .order_by(Payment.created_at.desc())
-        .first()
-    )
+        .limit(1)
+    )).scalar_one_or_none()
     if not payment:
         return {"status": "not_found", "booking_id": booking_id}
-    booking = db.query(Booking).filter(Booking.id == booking_id).first()
+    booking = await db.get(Booking, booking_id)
     return {
         "status": payment.status,
         "transaction_id": payment.transaction_id,
@@ -63,12 +73,95 @@ def payment_status(booking_id: int, db: Session = Depends(get_db)):
         "created_at": payment.created_at.isoformat() if payment.created_at else None,
     }
 
+
+async def _wait_for_final_status(booking_id: int, timeout: float) -> dict:
+    """Wait until the booking's payment is final (or `timeout`), then return its status."""
+    async def check():
+        # Fresh session per check so each one sees committed changes
+        async with AsyncSessionLocal() as db:
+            payload = await _status_payload(db, booking_id)
+        return payload if payload["status"] in FINAL_STATUSES else None
+
+    payload = await PAYMENT_EVENTS.wait(f"booking:{booking_id}", timeout, check=check)
+    if not isinstance(payload, dict):
+        # Woken by a publish (or timed out): read the stored state
+        async with AsyncSessionLocal() as db:
+            payload = await _status_payload(db, booking_id)
+    return payload
+
+
+@router.get("/status/{booking_id}")
+async def payment_status(
+    booking_id: int,
+    wait: float = Query(0, ge=0, description="Long-poll: seconds to wait for a final status"),
+    db: AsyncSession = Depends(get_async_db),
+):
+    payload = await _status_payload(db, booking_id)
+    # Don't hold a pooled connection while waiting
+    await db.close()
+    if wait and payload["status"] not in FINAL_STATUSES + ("not_found",):
+        payload = await _wait_for_final_status(booking_id, min(wait, MAX_STATUS_WAIT))
+    return payload
+
+
+@router.get("/status/{booking_id}/events")
+async def payment_status_events(
+    booking_id: int,
+    timeout: float = Query(MAX_STATUS_WAIT, gt=0),
+    db: AsyncSession = Depends(get_async_db),
+):
+    """Server-sent events: the current status, then the final one when it arrives."""
+    initial = await _status_payload(db, booking_id)
+    await db.close()
+    timeout = min(timeout, MAX_STATUS_WAIT)
+
+    async def events():
+        yield f"event: status\ndata: {json.dumps(initial)}\n\n"
+        if initial["status"] in FINAL_STATUSES + ("not_found",):
+            return
+        payload = await _wait_for_final_status(booking_id, timeout)
+        event = "status" if payload["status"] in FINAL_STATUSES else "timeout"
+        yield f"event: {event}\ndata: {json.dumps(payload)}\n\n"
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+async def _claim_payment(db: AsyncSession, checkout_request_id: str, values: dict) -> bool:
+    """
+    Move the payment for `checkout_request_id` to its final state, unless a
+    previous callback already did. The conditional UPDATE makes duplicate and
+    concurrent callbacks no-ops. Returns True only for the callback that won.
+    """
+    result = await db.execute(
+        update(Payment)
+        .where(Payment.checkout_request_id == checkout_request_id)
+        .where(Payment.status.not_in(FINAL_STATUSES))
+        .values(**values)
+    )
+    await db.commit()
+    return result.rowcount == 1
+
+
+async def _publish(db: AsyncSession, checkout_request_id: str, status: str):
+    booking_id = (await db.execute(
+        select(Payment.booking_id).filter(Payment.checkout_request_id == checkout_request_id)
+    )).scalar_one_or_none()
+    PAYMENT_EVENTS.publish(checkout_request_id, status)
+    if booking_id is not None:
+        PAYMENT_EVENTS.publish(f"booking:{booking_id}", status)
+
+
 @router.post("/callback")
-async def mpesa_callback(request: Request, db: Session = Depends(get_db)):
+async def mpesa_callback(request: Request, db: AsyncSession = Depends(get_async_db)):
     data = await request.json()
 
     # Parse callback
     body = data.get("Body", {}).get("stkCallback", {})
+    checkout_request_id = body.get("CheckoutRequestID")
     result_code = body.get("ResultCode")
     metadata = body.get("CallbackMetadata", {}).get("Item", [])
     transaction_id = None
@@ -83,33 +176,44 @@ async def mpesa_callback(request: Request, db: Session = Depends(get_db)):
         elif item["Name"] == "PhoneNumber":
             phone = str(item["Value"])
 
-    if result_code == 0:  # success
-        payment = db.query(Payment).filter(Payment.phone_number == phone).order_by(Payment.created_at.desc()).first()
-        if payment:
-            payment.status = "success"
-            payment.transaction_id = transaction_id
-            booking = db.query(Booking).filter(Booking.id == payment.booking_id).first()
-            if booking:
-                booking.status = "paid"
-            db.commit()
-            # Generate receipt and notify customer via WhatsApp
-            try:
-                if booking:
-                    filename = generate_receipt_pdf(booking, payment)
-                    file_path = os.path.abspath(filename)
-                    message = (
-                        f"Payment received successfully.\n"
-                        f"Booking ID: {booking.id}\n"
-                        f"Service: {booking.service_name}\n"
-                        f"Amount Paid: KES {payment.amount}\n"
-                        f"Receipt: {file_path}"
-                    )
-                    # send WhatsApp message (async-friendly wrapper)
-                    await send_whatsapp_message(phone, message)
-            except Exception:
-                # Continue even if sending the WhatsApp message fails
-                pass
-        return {"ResultCode": 0, "ResultDesc": "Accepted"}
-    else:
+    if not checkout_request_id:
+        return {"ResultCode": 1, "ResultDesc": "Missing CheckoutRequestID"}
+
+    if result_code != 0:
+        if await _claim_payment(db, checkout_request_id, {"status": "failed"}):
+            await _publish(db, checkout_request_id, "failed")
         return {"ResultCode": 1, "ResultDesc": "Failed"}
 
+    if not await _claim_payment(
+        db, checkout_request_id, {"status": "success", "transaction_id": transaction_id}
+    ):
+        # Unknown checkout, or a duplicate of a callback already handled
+        return {"ResultCode": 0, "ResultDesc": "Accepted"}
+
+    payment = (await db.execute(
+        select(Payment).filter(Payment.checkout_request_id == checkout_request_id)
+    )).scalar_one()
+    booking = await db.get(Booking, payment.booking_id)
+    if booking:
+        booking.status = "paid"
+        await db.commit()
+    PAYMENT_EVENTS.publish(checkout_request_id, "success")
+    PAYMENT_EVENTS.publish(f"booking:{payment.booking_id}", "success")
+    # Generate receipt and notify customer via WhatsApp
+    try:
+        if booking:
+            key, _ = await RECEIPT_RENDERER.render(receipt_fields(booking, payment))
+            url, _ = receipt_url(key)
+            message = (
+                f"Payment received successfully.\n"
+                f"Booking ID: {booking.id}\n"
+                f"Service: {booking.service_name}\n"
+                f"Amount Paid: KES {payment.amount}\n"
+                f"Receipt: {url}"
+            )
+            # The PDF goes out as WhatsApp media, fetched by Twilio from the signed link
+            await send_whatsapp_message(phone or payment.phone_number, message, media_url=url)
+    except Exception:
+        # Continue even if sending the WhatsApp message fails
+        pass
+    return {"ResultCode": 0, "ResultDesc": "Accepted"}
@@ -1,76 +1,180 @@
 # app/api/receipts.py
-from fastapi import APIRouter, Depends, HTTPException
-from sqlalchemy.orm import Session
-from app.database import get_db
+from fastapi import APIRouter, Depends, HTTPException, Query, Request
+from fastapi.responses import FileResponse, Response, StreamingResponse
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.database import get_async_db, AsyncSessionLocal
 from app.schemas import Booking, Payment
-from fpdf import FPDF
+from app.utils.etags import if_none_match
+from app.utils.pdf_generator import receipt_fields, RECEIPT_RENDERER
+from app.utils.signed_urls import receipt_path, receipt_url, verify
+from datetime import date, datetime, time, timedelta, timezone
+from typing import Literal, Optional
+import asyncio
 import os
-from datetime import datetime
-
-router = APIRouter(prefix="/api/receipts", tags=["Receipts"])
-
-def generate_receipt_pdf(booking: Booking, payment: Payment) -> str:
-    """Generate a PDF receipt using FPDF library"""
-    pdf = FPDF()
-    pdf.add_page()
-
-    # Title
-    pdf.set_font("Arial", "B", 16)
-    pdf.cell(0, 10, "RECEIPT", ln=True, align="C")
-    pdf.ln(10)
-
-    # Receipt details
-    pdf.set_font("Arial", "", 12)
-    pdf.cell(0, 10, f"Receipt Date: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}", ln=True)
-    pdf.cell(0, 10, f"Booking ID: {booking.id}", ln=True)
-    pdf.cell(0, 10, f"Payment ID: {payment.id}", ln=True)
-    pdf.ln(5)
-
-    # Booking information
-    pdf.set_font("Arial", "B", 14)
-    pdf.cell(0, 10, "Booking Details", ln=True)
-    pdf.set_font("Arial", "", 12)
-
-    # Add booking details (adjust based on your Booking model attributes)
-    if hasattr(booking, 'customer_name'):
-        pdf.cell(0, 10, f"Customer: {booking.customer_name}", ln=True)
-    if hasattr(booking, 'service'):
-        pdf.cell(0, 10, f"Service: {booking.service}", ln=True)
-    if hasattr(booking, 'booking_date'):
-        pdf.cell(0, 10, f"Date: {booking.booking_date}", ln=True)
-
-    pdf.ln(5)
-
-    # Payment information
-    pdf.set_font("Arial", "B", 14)
-    pdf.cell(0, 10, "Payment Details", ln=True)
-    pdf.set_font("Arial", "", 12)
-    pdf.cell(0, 10, f"Amount: ${payment.amount:.2f}", ln=True)
-    pdf.cell(0, 10, f"Payment Method: {payment.payment_method if hasattr(payment, 'payment_method') else 'N/A'}", ln=True)
-    pdf.cell(0, 10, f"Status: {payment.status}", ln=True)
-
-    pdf.ln(10)
-    pdf.set_font("Arial", "I", 10)
-    pdf.cell(0, 10, "Thank you for your business!", ln=True, align="C")
-
-    # Save PDF
-    os.makedirs("receipts", exist_ok=True)
-    filename = f"receipts/receipt_{booking.id}_{payment.id}.pdf"
-    pdf.output(filename)
-
-    return filename
+import re
+import tempfile
+import zipfile
+
+# Mounted under /api/receipts by app.main
+router = APIRouter()
+
+RECEIPT_KEY = re.compile(r"^[0-9a-f]{64}$")
+
+
+def receipt_link(key: str) -> dict:
+    """Signed, expiring download link for a rendered receipt."""
+    url, expires = receipt_url(key)
+    return {
+        "receipt_key": key,
+        "receipt_url": url,
+        "expires_at": datetime.fromtimestamp(expires, timezone.utc).isoformat(),
+    }
+
 
 @router.post("/generate/{booking_id}")
-def generate_receipt(booking_id: int, db: Session = Depends(get_db)):
-    booking = db.query(Booking).filter(Booking.id == booking_id).first()
+async def generate_receipt(booking_id: int, db: AsyncSession = Depends(get_async_db)):
+    booking = await db.get(Booking, booking_id)
     if not booking:
         raise HTTPException(status_code=404, detail="Booking not found")
 
-    payment = db.query(Payment).filter(Payment.booking_id == booking.id, Payment.status == "success").first()
+    payment = (await db.execute(
+        select(Payment).filter(Payment.booking_id == booking.id, Payment.status == "success").limit(1)
+    )).scalar_one_or_none()
     if not payment:
         raise HTTPException(status_code=400, detail="Payment not completed")
 
-    filename = generate_receipt_pdf(booking, payment)
-    file_path = os.path.abspath(filename)
+    # Rendered in the receipt process pool; unchanged receipts come from the cache
+    key, _ = await RECEIPT_RENDERER.render(receipt_fields(booking, payment))
+    return receipt_link(key)
+
+
+@router.get("/download/{key}.pdf")
+async def download_receipt(key: str, request: Request, expires: int, sig: str):
+    """
+    Serve a cached receipt PDF through a signed link. The key is the hash of
+    the receipt's content, so it doubles as a strong ETag; Range requests
+    are honoured.
+    """
+    problem = verify(receipt_path(key), expires, sig)
+    if problem == "expired":
+        raise HTTPException(status_code=410, detail="Receipt link has expired")
+    if problem or not RECEIPT_KEY.match(key):
+        raise HTTPException(status_code=403, detail="Invalid receipt link")
+
+    path = RECEIPT_RENDERER.path_for(key)
+    if not await asyncio.to_thread(path.exists):
+        raise HTTPException(status_code=404, detail="Receipt not found")
+
+    etag = f'"{key}"'
+    headers = {"ETag": etag, "Cache-Control": "private, max-age=86400, immutable"}
+    if if_none_match(request, etag):
+        return Response(status_code=304, headers=headers)
+    return FileResponse(
+        path,
+        media_type="application/pdf",
+        filename=f"receipt_{key[:12]}.pdf",
+        content_disposition_type="inline",
+        headers=headers,
+    )
+
+# Rows fetched from the DB cursor and rendered per pool call during exports
+EXPORT_BATCH_SIZE = int(os.getenv("RECEIPT_EXPORT_BATCH_SIZE", "200"))
+STREAM_CHUNK_SIZE = 64 * 1024
+
+
+class _ChunkBuffer:
+    """Write-only file object that zipfile writes into and the response drains."""
+
+    def __init__(self):
+        self._chunks: list[bytes] = []
+
+    def write(self, data: bytes) -> int:
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def _export_query(date_from: Optional[date], date_to: Optional[date], status: str):
+    query = (
+        select(Booking, Payment)
+        .join(Payment, Payment.booking_id == Booking.id)
+        .filter(Payment.status == status)
+    )
+    if date_from:
+        query = query.filter(Payment.created_at >= datetime.combine(date_from, time.min))
+    if date_to:
+        query = query.filter(Payment.created_at < datetime.combine(date_to + timedelta(days=1), time.min))
+    return query.order_by(Payment.created_at, Payment.id).execution_options(yield_per=EXPORT_BATCH_SIZE)
+
+
+async def _receipt_batches(query):
+    """Yield lists of (booking, payment, fields) read through a server-side cursor."""
+    # Own session: the response body is streamed after the route has returned
+    async with AsyncSessionLocal() as db:
+        result = await db.stream(query)
+        async for rows in result.partitions(EXPORT_BATCH_SIZE):
+            yield [(booking, payment, receipt_fields(booking, payment)) for booking, payment in rows]
+
+
+async def _zip_stream(query):
+    buffer = _ChunkBuffer()
+    # PDFs are already compressed; deflating them again would only burn
+    # event-loop time that the chat endpoints need
+    with zipfile.ZipFile(buffer, "w", compression=zipfile.ZIP_STORED) as archive:
+        async for batch in _receipt_batches(query):
+            pdfs = await RECEIPT_RENDERER.render_batch([fields for _, _, fields in batch])
+            for (booking, payment, _), pdf in zip(batch, pdfs):
+                archive.writestr(f"receipt_{booking.id}_{payment.id}.pdf", pdf)
+            if data := buffer.drain():
+                yield data
+    yield buffer.drain()  # central directory
+
+
+async def _statement_stream(query):
+    fields_list = []
+    async for batch in _receipt_batches(query):
+        fields_list.extend(fields for _, _, fields in batch)
+    fd, path = tempfile.mkstemp(suffix=".pdf")
+    os.close(fd)
+    try:
+        await RECEIPT_RENDERER.render_statement(fields_list, path)
+        del fields_list
+        with open(path, "rb") as f:
+            while chunk := await asyncio.to_thread(f.read, STREAM_CHUNK_SIZE):
+                yield chunk
+    finally:
+        os.unlink(path)
+
 
-    return {"receipt_path": file_path}
+@router.get("/export")
+async def export_receipts(
+    date_from: Optional[date] = Query(None, description="First payment date to include"),
+    date_to: Optional[date] = Query(None, description="Last payment date to include"),
+    status: str = Query("success", description="Payment status to export"),
+    format: Literal["zip", "pdf"] = Query("zip", description="zip: one PDF per receipt; pdf: one multi-page statement"),
+):
+    """
+    Bulk receipts for reconciliation, streamed while they render: a ZIP of
+    receipt PDFs or a single statement PDF with one page per receipt.
+    """
+    query = _export_query(date_from, date_to, status)
+    label = f"{date_from or 'start'}_{date_to or 'now'}"
+    if format == "pdf":
+        return StreamingResponse(
+            _statement_stream(query),
+            media_type="application/pdf",
+            headers={"Content-Disposition": f'attachment; filename="statement_{label}.pdf"'},
+        )
+    return StreamingResponse(
+        _zip_stream(query),
+        media_type="application/zip",
+        headers={"Content-Disposition": f'attachment; filename="receipts_{label}.zip"'},
+    )
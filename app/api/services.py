@@ -1,23 +1,33 @@
-
-from fastapi import APIRouter, HTTPException
-import json
-from pathlib import Path
+from fastapi import APIRouter, HTTPException, Query, Request
+from fastapi.responses import JSONResponse, Response
+from app.catalog import CATALOG
+from app.utils.etags import if_none_match
 
 router = APIRouter()
 
+
+def _cached_json(request: Request, payload: dict, etag: str):
+    """Serve `payload` with an ETag, or 304 if the client already has it."""
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if if_none_match(request, etag):
+        return Response(status_code=304, headers=headers)
+    return JSONResponse(payload, headers=headers)
+
+
 @router.get("/")
-def get_business_info():
-    data_path = Path("business.json")
-    if not data_path.exists():
+def get_business_info(request: Request):
+    try:
+        business_data = CATALOG.data
+    except FileNotFoundError:
         raise HTTPException(status_code=404, detail="Business data not found")
-
-    with open(data_path) as f:
-        business_data = json.load(f)
-    return business_data
+    return _cached_json(request, business_data, CATALOG.etag)
 
 @router.get("/list")
-def get_services():
-    data_path = Path("business.json")
-    with open(data_path) as f:
-        data = json.load(f)
-    return {"services": data.get("services", [])}
+def get_services(request: Request):
+    services = CATALOG.services
+    return _cached_json(request, services, CATALOG.services_etag)
+
+@router.get("/resolve")
+def resolve_service(q: str = Query(..., min_length=1), limit: int = Query(3, ge=1, le=10)):
+    """Rank catalog services against a free-text name such as "gel mani" or "knotless braid"."""
+    return {"query": q, "matches": CATALOG.resolve(q, limit=limit)}
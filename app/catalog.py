@@ -0,0 +1,118 @@
+# app/catalog.py
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from pathlib import Path
+from app.service_resolver import ServiceResolver
+
+logger = logging.getLogger("catalog")
+
+BUSINESS_DATA_PATH = Path(os.getenv("BUSINESS_DATA_PATH", "business.json"))
+
+# Item fields that only feed the service resolver and are never served
+RESOLVER_ONLY_FIELDS = ("aliases",)
+
+
+def _public(data: dict) -> dict:
+    """`data` without resolver-only item fields."""
+    return {
+        **data,
+        "services": [
+            {
+                **category,
+                "items": [
+                    {k: v for k, v in item.items() if k not in RESOLVER_ONLY_FIELDS}
+                    for item in category.get("items", [])
+                ],
+            }
+            for category in data.get("services", [])
+        ],
+    }
+
+
+class BusinessCatalog:
+    """
+    business.json parsed once and kept in memory.
+    The file's mtime is checked at most every `check_interval` seconds and the
+    catalog is reloaded when it changes. Service lookups go through a
+    precomputed lowercase name -> item index. An edit that leaves the file
+    invalid is logged and skipped; the last good version keeps being served.
+    """
+
+    def __init__(self, path: str | Path = BUSINESS_DATA_PATH, check_interval: float = 1.0):
+        self.path = Path(path)
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._mtime: int | None = None
+        self._checked_at = 0.0
+        self._data: dict = {}
+        self._services: dict = {}
+        self._index: dict[str, dict] = {}
+        self._resolver = ServiceResolver([])
+        self.etag = ""
+        self.services_etag = ""
+        self.version = 0
+
+    def _refresh(self):
+        now = time.monotonic()
+        if self._mtime is not None and now - self._checked_at < self.check_interval:
+            return
+        with self._lock:
+            mtime = self.path.stat().st_mtime_ns  # FileNotFoundError if missing
+            self._checked_at = now
+            if mtime == self._mtime:
+                return
+            raw = self.path.read_bytes()
+            try:
+                document = json.loads(raw)
+                data = _public(document)
+                services = {"services": data["services"]}
+                index = {}
+                for category in document.get("services", []):
+                    for item in category.get("items", []):
+                        index[item.get("name", "").lower()] = {**item, "category": category.get("category")}
+            except (ValueError, TypeError, AttributeError):
+                if not self.version:
+                    raise  # nothing good to fall back to
+                # Not re-read until the file changes again
+                logger.exception("Ignoring invalid %s, still serving version %d", self.path, self.version)
+                self._mtime = mtime
+                return
+            self._data = data
+            self._services = services
+            self._index = index
+            self._resolver = ServiceResolver(list(index.values()))
+            self.etag = '"%s"' % hashlib.sha1(json.dumps(data, sort_keys=True).encode()).hexdigest()
+            self.services_etag = '"%s"' % hashlib.sha1(
+                json.dumps(services, sort_keys=True).encode()
+            ).hexdigest()
+            self._mtime = mtime
+            self.version += 1
+
+    @property
+    def data(self) -> dict:
+        """The business.json document without resolver-only fields (treat as read-only)."""
+        self._refresh()
+        return self._data
+
+    @property
+    def services(self) -> dict:
+        """`{"services": [...]}` as served by /api/services/list (treat as read-only)."""
+        self._refresh()
+        return self._services
+
+    def get_item(self, service_name: str) -> dict | None:
+        """Case-insensitive exact lookup; returns the item plus its category, or None."""
+        self._refresh()
+        return self._index.get(service_name.strip().lower())
+
+    def resolve(self, query: str, limit: int = 3) -> list[dict]:
+        """Ranked fuzzy matches for a free-text service name (see ServiceResolver)."""
+        self._refresh()
+        return self._resolver.resolve(query, limit=limit)
+
+
+CATALOG = BusinessCatalog()
@@ -1,7 +1,9 @@
-
 # app/database.py
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event, inspect
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
 from sqlalchemy.orm import sessionmaker, declarative_base
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool, StaticPool
 from dotenv import load_dotenv
 import os
 
@@ -9,9 +11,143 @@ load_dotenv()
 
 DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./glow_haven.db")
 
-engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False})  # Needed for SQLite
+# SQLite performance profile, applied to every new connection.
+# WAL lets readers run alongside the single writer, synchronous=NORMAL only
+# fsyncs at checkpoints in WAL mode, and busy_timeout makes writers wait for
+# the lock instead of failing with "database is locked".
+SQLITE_PRAGMAS = {
+    "journal_mode": os.getenv("SQLITE_JOURNAL_MODE", "WAL"),
+    "synchronous": os.getenv("SQLITE_SYNCHRONOUS", "NORMAL"),
+    "busy_timeout": int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000")),
+    "mmap_size": int(os.getenv("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024))),
+    "cache_size": int(os.getenv("SQLITE_CACHE_SIZE", "-65536")),  # negative = KiB
+    "temp_store": os.getenv("SQLITE_TEMP_STORE", "MEMORY"),
+}
+
+
+def is_sqlite(url: str) -> bool:
+    return url.startswith("sqlite")
+
+
+def is_memory_sqlite(url: str) -> bool:
+    """True for in-memory SQLite URLs, whatever the driver (sqlite://, sqlite+aiosqlite:///:memory:, ...)."""
+    parsed = make_url(url)
+    if parsed.get_backend_name() != "sqlite":
+        return False
+    return parsed.database in (None, "", ":memory:") or "mode=memory" in url
+
+
+def engine_options(url: str) -> dict:
+    """Pool/connect settings suited to the backend behind `url`."""
+    if is_sqlite(url):
+        connect_args = {
+            "check_same_thread": False,  # Needed for SQLite
+            "timeout": SQLITE_PRAGMAS["busy_timeout"] / 1000,
+        }
+        if is_memory_sqlite(url):
+            # One shared connection, otherwise every checkout sees a new empty database
+            return {"connect_args": connect_args, "poolclass": StaticPool}
+        # Connections are cheap and there is a single writer: a small pool
+        # keeps pages cached per connection without piling up write contention
+        return {
+            "connect_args": connect_args,
+            "poolclass": QueuePool,
+            "pool_size": int(os.getenv("DB_POOL_SIZE", "5")),
+            "max_overflow": int(os.getenv("DB_MAX_OVERFLOW", "10")),
+        }
+    # Server databases: larger pool, drop dead connections before use
+    return {
+        "pool_size": int(os.getenv("DB_POOL_SIZE", "10")),
+        "max_overflow": int(os.getenv("DB_MAX_OVERFLOW", "20")),
+        "pool_pre_ping": True,
+        "pool_recycle": int(os.getenv("DB_POOL_RECYCLE", "1800")),
+    }
+
+
+def apply_sqlite_pragmas(dbapi_connection, pragmas: dict = SQLITE_PRAGMAS) -> None:
+    cursor = dbapi_connection.cursor()
+    try:
+        for name, value in pragmas.items():
+            cursor.execute(f"PRAGMA {name}={value}")
+    finally:
+        cursor.close()
+
+
+def make_engine(url: str = DATABASE_URL, pragmas: dict | None = SQLITE_PRAGMAS):
+    """Create an engine using the performance profile for its backend (pragmas=None disables tuning)."""
+    engine = create_engine(url, **engine_options(url))
+    if is_sqlite(url) and pragmas:
+        @event.listens_for(engine, "connect")
+        def _on_connect(dbapi_connection, connection_record):
+            apply_sqlite_pragmas(dbapi_connection, pragmas)
+    return engine
+
+
+# Async drivers used by async routes for each sync backend
+ASYNC_DRIVERS = {
+    "sqlite": "sqlite+aiosqlite",
+    "postgresql": "postgresql+asyncpg",
+    "mysql": "mysql+aiomysql",
+}
+
+
+def async_url(url: str) -> str:
+    """Map a sync DATABASE_URL to the equivalent async-driver URL."""
+    parsed = make_url(url)
+    backend = parsed.get_backend_name()
+    driver = ASYNC_DRIVERS.get(backend)
+    explicit_driver = parsed.drivername not in (backend, "sqlite+pysqlite")
+    if driver is None or explicit_driver:
+        # Unknown backend, or a driver was chosen explicitly: use as given
+        return url
+    return parsed.set(drivername=driver).render_as_string(hide_password=False)
+
+
+def make_async_engine(url: str = DATABASE_URL, pragmas: dict | None = SQLITE_PRAGMAS):
+    """Async counterpart of make_engine, with the same profile."""
+    url = os.getenv("ASYNC_DATABASE_URL") or async_url(url)
+    options = engine_options(url)
+    if options.get("poolclass") is QueuePool:
+        options["poolclass"] = AsyncAdaptedQueuePool
+    options.get("connect_args", {}).pop("check_same_thread", None)
+    engine = create_async_engine(url, **options)
+    if is_sqlite(url) and pragmas:
+        @event.listens_for(engine.sync_engine, "connect")
+        def _on_connect(dbapi_connection, connection_record):
+            apply_sqlite_pragmas(dbapi_connection, pragmas)
+    return engine
+
+
+def add_missing_columns(bind, metadata) -> list[str]:
+    """
+    Add columns that exist on the models but not yet in the database.
+    create_all never alters existing tables; this covers new nullable columns
+    (their indexes are created separately). Returns the added "table.column"s.
+    """
+    inspector = inspect(bind)
+    existing_tables = set(inspector.get_table_names())
+    added = []
+    with bind.begin() as conn:
+        for table in metadata.sorted_tables:
+            if table.name not in existing_tables:
+                continue
+            present = {c["name"] for c in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in present:
+                    continue
+                column_type = column.type.compile(dialect=bind.dialect)
+                conn.exec_driver_sql(f'ALTER TABLE "{table.name}" ADD COLUMN "{column.name}" {column_type}')
+                added.append(f"{table.name}.{column.name}")
+    return added
+
+
+engine = make_engine()
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+# Async path for `async def` routes, so queries don't block the event loop
+async_engine = make_async_engine()
+AsyncSessionLocal = async_sessionmaker(async_engine, expire_on_commit=False, autoflush=False)
+
 Base = declarative_base()
 
 # Dependency for FastAPI routes
@@ -21,3 +157,8 @@ def get_db():
         yield db
     finally:
         db.close()
+
+# Dependency for async FastAPI routes
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
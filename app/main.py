@@ -1,9 +1,14 @@
 
 from fastapi import FastAPI
-from whatsapp.webhook import router as whatsapp_router
+from whatsapp.webhook import router as whatsapp_router, INBOUND_QUEUE
+from whatsapp.bot import MCP_POOL
+from whatsapp.memory import MEMORY_STORE
+from whatsapp.client import TWILIO_SENDER
 from app.api import services, bookings, payments, receipts, feedback
 from fastapi.middleware.cors import CORSMiddleware
-from app.database import Base, engine
+from app.database import Base, engine, async_engine, add_missing_columns
+from app.utils.mpesa import DARAJA_CLIENT
+from app.utils.pdf_generator import RECEIPT_RENDERER
 from app import schemas  # noqa: F401 - ensure models are imported so metadata is populated
 
 app = FastAPI(title="Glow Haven Beauty Lounge API")
@@ -18,6 +23,29 @@ app.add_middleware(
 @app.on_event("startup")
 def on_startup() -> None:
     Base.metadata.create_all(bind=engine)
+    # create_all never alters existing tables; add new columns, then any
+    # indexes an existing database is missing
+    add_missing_columns(engine, Base.metadata)
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind=engine, checkfirst=True)
+
+@app.on_event("startup")
+async def start_inbound_workers() -> None:
+    await INBOUND_QUEUE.start()
+
+@app.on_event("shutdown")
+async def on_shutdown() -> None:
+    # Drain in-flight WhatsApp messages before tearing down tool sessions
+    await INBOUND_QUEUE.stop()
+    await MCP_POOL.close()
+    # Flush write-behind chat memory
+    await MEMORY_STORE.close()
+    # Let queued replies go out
+    await TWILIO_SENDER.close()
+    await DARAJA_CLIENT.close()
+    await RECEIPT_RENDERER.close()
+    await async_engine.dispose()
 
 # Routers
 app.include_router(services.router, prefix="/api/services", tags=["Services"])
@@ -2,7 +2,7 @@
 # app/models.py
 from pydantic import BaseModel
 from datetime import date, time, datetime
-from typing import Optional
+from typing import List, Optional
 
 # ----------- BOOKINGS -----------
 class BookingCreate(BaseModel):
@@ -23,10 +23,15 @@ class BookingResponse(BaseModel):
     status: str
     amount: float
     created_at: datetime
+    calendar_event_id: Optional[str] = None
 
     class Config:
         from_attributes = True
 
+class BookingPage(BaseModel):
+    items: List[BookingResponse]
+    next_cursor: Optional[str] = None  # pass back as ?cursor= for the next page
+
 
 # ----------- PAYMENTS -----------
 class PaymentCreate(BaseModel):
@@ -40,6 +45,7 @@ class PaymentResponse(BaseModel):
     phone_number: str
     amount: float
     transaction_id: Optional[str]
+    checkout_request_id: Optional[str] = None
     status: str
     created_at: datetime
 
@@ -0,0 +1,81 @@
+# app/payment_events.py
+import asyncio
+import os
+from typing import Awaitable, Callable
+
+# Payment states no later callback can change
+FINAL_STATUSES = ("success", "failed")
+
+StatusCheck = Callable[[], Awaitable[str | None]]
+
+
+class PaymentEvents:
+    """
+    In-process notification hub for payment outcomes.
+    The M-Pesa callback publishes the final status under a key (checkout
+    request id, booking id, ...) and every coroutine waiting on that key wakes
+    immediately. Waiters may pass a `check` coroutine that reads the stored
+    status; it runs once on entry (the callback may already have happened)
+    and then every `poll_interval` seconds, which catches callbacks handled
+    by another process.
+    """
+
+    def __init__(self, poll_interval: float = 15.0):
+        self.poll_interval = poll_interval
+        self._waiters: dict[str, set[asyncio.Future]] = {}
+        self.published = 0
+
+    def publish(self, key, status: str):
+        """Wake everyone waiting on `key` with `status`."""
+        self.published += 1
+        for future in self._waiters.pop(str(key), ()):
+            if not future.done():
+                future.set_result(status)
+
+    def _discard(self, key: str, future: asyncio.Future):
+        waiters = self._waiters.get(key)
+        if waiters is not None:
+            waiters.discard(future)
+            if not waiters:
+                del self._waiters[key]
+
+    async def wait(
+        self,
+        key,
+        timeout: float,
+        check: StatusCheck | None = None,
+        poll_interval: float | None = None,
+    ) -> str | None:
+        """Return the published (or checked) status for `key`, or None on timeout."""
+        key = str(key)
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        interval = poll_interval or self.poll_interval
+        while True:
+            # Register before checking so a publish in between is not missed
+            future = loop.create_future()
+            self._waiters.setdefault(key, set()).add(future)
+            try:
+                if check is not None:
+                    status = await check()
+                    if status is not None:
+                        return status
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    return None
+                try:
+                    return await asyncio.wait_for(future, min(remaining, interval))
+                except asyncio.TimeoutError:
+                    continue
+            finally:
+                self._discard(key, future)
+
+    def snapshot(self) -> dict:
+        return {
+            "waiting_keys": len(self._waiters),
+            "waiters": sum(len(w) for w in self._waiters.values()),
+            "published": self.published,
+        }
+
+
+PAYMENT_EVENTS = PaymentEvents(poll_interval=float(os.getenv("PAYMENT_POLL_INTERVAL", "15")))
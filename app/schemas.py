@@ -1,6 +1,6 @@
 
 # app/schemas.py
-from sqlalchemy import Column, Integer, String, Float, Date, Time, Boolean, ForeignKey, DateTime
+from sqlalchemy import Column, Integer, String, Float, Date, Time, Boolean, ForeignKey, DateTime, Index
 from sqlalchemy.orm import relationship
 from datetime import datetime
 from app.database import Base
@@ -12,11 +12,18 @@ class Booking(Base):
     customer_name = Column(String, nullable=False)
     phone_number = Column(String, nullable=False)
     service_name = Column(String, nullable=False)
-    date = Column(Date, nullable=False)
+    date = Column(Date, nullable=False, index=True)
     time = Column(Time, nullable=False)
-    status = Column(String, default="pending")  # pending, paid, cancelled
+    status = Column(String, default="pending", index=True)  # pending, paid, cancelled
     amount = Column(Float, nullable=False)
     created_at = Column(DateTime, default=datetime.utcnow)
+    calendar_event_id = Column(String, nullable=True)  # Google Calendar event, once synced
+
+    # Keyset pagination walks (created_at, id) newest first, optionally per phone
+    __table_args__ = (
+        Index("ix_bookings_created_at_id", "created_at", "id"),
+        Index("ix_bookings_phone_created_at", "phone_number", "created_at", "id"),
+    )
 
     payment = relationship("Payment", back_populates="booking", uselist=False)
 
@@ -29,7 +36,14 @@ class Payment(Base):
     phone_number = Column(String, nullable=False)
     amount = Column(Float, nullable=False)
     transaction_id = Column(String, unique=True, nullable=True)
-    status = Column(String, default="initiated")  # initiated, success, failed
+    # Daraja's CheckoutRequestID; callbacks are matched on it
+    checkout_request_id = Column(String, unique=True, index=True, nullable=True)
+    status = Column(String, default="initiated")  # initiated, pending, success, failed
     created_at = Column(DateTime, default=datetime.utcnow)
 
     booking = relationship("Booking", back_populates="payment")
+
+    __table_args__ = (
+        # Receipt exports filter by status and payment date
+        Index("ix_payments_status_created_at", "status", "created_at"),
+    )
@@ -0,0 +1,77 @@
+# app/service_resolver.py
+import re
+from collections import defaultdict
+
+_WORD = re.compile(r"[a-z0-9]+")
+
+
+def _tokens(text: str) -> list[str]:
+    # Crude singularization so "braids" matches "braid" and "nails" matches "nail"
+    return [w[:-1] if len(w) > 3 and w.endswith("s") and not w.endswith("ss") else w
+            for w in _WORD.findall(text.lower())]
+
+
+def _normalize(text: str) -> str:
+    return " ".join(_tokens(text))
+
+
+def _trigrams(text: str) -> set[str]:
+    padded = f"  {text} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class ServiceResolver:
+    """
+    Fuzzy lookup of service names and aliases.
+    Every name/alias is normalized and indexed by its character trigrams, so a
+    query only scores entries sharing at least one trigram with it. Scores mix
+    trigram similarity (typos, partial words) with token overlap, where a query
+    word that is a prefix of an indexed word counts ("mani" -> "manicure").
+    """
+
+    def __init__(self, items: list[dict]):
+        self._entries: list[tuple[str, set[str], list[str], dict]] = []
+        self._by_trigram: dict[str, set[int]] = defaultdict(set)
+        for item in items:
+            keys = {item["name"], re.sub(r"\(.*?\)", "", item["name"])}
+            keys.update(item.get("aliases", []))
+            for key in keys:
+                text = _normalize(key)
+                if not text:
+                    continue
+                grams = _trigrams(text)
+                index = len(self._entries)
+                self._entries.append((text, grams, text.split(), item))
+                for gram in grams:
+                    self._by_trigram[gram].add(index)
+
+    def resolve(self, query: str, limit: int = 3, min_score: float = 0.3) -> list[dict]:
+        """Return up to `limit` distinct services, best first, as `{**item, "score", "matched"}`."""
+        text = _normalize(query)
+        if not text:
+            return []
+        grams = _trigrams(text)
+        words = text.split()
+        candidates = set()
+        for gram in grams:
+            candidates |= self._by_trigram.get(gram, set())
+
+        best: dict[str, tuple[float, str, dict]] = {}
+        for index in candidates:
+            key, key_grams, key_words, item = self._entries[index]
+            if key == text:
+                score = 1.0
+            else:
+                trigram = len(grams & key_grams) / len(grams | key_grams)
+                hits = sum(1 for w in words if any(k.startswith(w) or w.startswith(k) for k in key_words))
+                overlap = hits / max(len(words), len(key_words))
+                score = 0.5 * trigram + 0.5 * overlap
+            name = item["name"]
+            if score >= min_score and score > best.get(name, (0.0,))[0]:
+                best[name] = (score, key, item)
+
+        ranked = sorted(best.values(), key=lambda entry: entry[0], reverse=True)[:limit]
+        return [
+            {**{k: v for k, v in item.items() if k != "aliases"}, "score": round(score, 3), "matched": key}
+            for score, key, item in ranked
+        ]
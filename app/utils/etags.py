@@ -0,0 +1,21 @@
+# app/utils/etags.py
+from starlette.requests import Request
+
+
+def _opaque(tag: str) -> str:
+    tag = tag.strip()
+    return tag[2:] if tag.startswith("W/") else tag
+
+
+def if_none_match(request: Request, etag: str) -> bool:
+    """
+    True if the request's If-None-Match covers `etag`, i.e. a 304 can be sent.
+    Handles lists of tags, weak (W/) validators and "*", compared weakly as
+    RFC 9110 requires for If-None-Match.
+    """
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    return _opaque(etag) in {_opaque(tag) for tag in header.split(",")}
@@ -1,8 +1,11 @@
 
 import os
+import time
 import base64
-import aiohttp
+import asyncio
+import httpx
 from datetime import datetime
+from typing import Callable
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -17,26 +20,105 @@ MPESA_CALLBACK_URL = os.getenv(
     "https://10ad98e5ed65.ngrok-free.app/api/payments/callback"
 )
 
-MPESA_BASE_URL = (
+# MPESA_BASE_URL can point at a local fake Daraja server for tests
+MPESA_BASE_URL = os.getenv("MPESA_BASE_URL") or (
     "https://sandbox.safaricom.co.ke"
     if MPESA_ENV == "sandbox"
     else "https://api.safaricom.co.ke"
 )
 
 
-async def get_access_token() -> str:
+class DarajaClient:
     """
-    Generate OAuth access token for M-Pesa Daraja API (async)
+    Shared Daraja API client.
+    - One pooled keep-alive HTTP client for every call
+    - OAuth token cached until shortly before `expires_in` runs out
+    - Single-flight refresh: concurrent payments wait for one token request
     """
-    url = f"{MPESA_BASE_URL}/oauth/v1/generate?grant_type=client_credentials"
 
-    async with aiohttp.ClientSession() as session:
-        async with session.get(url, auth=aiohttp.BasicAuth(MPESA_CONSUMER_KEY, MPESA_CONSUMER_SECRET)) as response:
-            if response.status == 200:
-                data = await response.json()
-                return data.get("access_token")
-            text = await response.text()
-            raise Exception(f"❌ Failed to get access token: {text}")
+    def __init__(
+        self,
+        base_url: str,
+        consumer_key: str | None,
+        consumer_secret: str | None,
+        expiry_margin: float = 60.0,
+        transport: httpx.AsyncBaseTransport | None = None,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.base_url = base_url
+        self.consumer_key = consumer_key
+        self.consumer_secret = consumer_secret
+        self.expiry_margin = expiry_margin
+        self._transport = transport
+        self._clock = clock  # token expiry only; tests pass a fake
+        self._http: httpx.AsyncClient | None = None
+        self._token: str | None = None
+        self._expires_at = 0.0
+        self._token_lock = asyncio.Lock()
+
+    @property
+    def http(self) -> httpx.AsyncClient:
+        if self._http is None:
+            self._http = httpx.AsyncClient(
+                base_url=self.base_url,
+                timeout=httpx.Timeout(30.0),
+                limits=httpx.Limits(max_keepalive_connections=10),
+                transport=self._transport,
+            )
+        return self._http
+
+    async def get_access_token(self) -> str:
+        if self._token and self._clock() < self._expires_at:
+            return self._token
+        async with self._token_lock:
+            # Another caller may have refreshed it while we waited
+            if self._token and self._clock() < self._expires_at:
+                return self._token
+            response = await self.http.get(
+                "/oauth/v1/generate",
+                params={"grant_type": "client_credentials"},
+                auth=(self.consumer_key, self.consumer_secret),
+            )
+            if response.status_code != 200:
+                raise Exception(f"❌ Failed to get access token: {response.text}")
+            data = response.json()
+            expires_in = float(data.get("expires_in") or 3599)  # absent or null: Daraja's usual hour
+            self._token = data.get("access_token")
+            self._expires_at = self._clock() + max(0.0, expires_in - self.expiry_margin)
+            return self._token
+
+    def invalidate_token(self):
+        self._token = None
+        self._expires_at = 0.0
+
+    async def stk_push(self, payload: dict) -> httpx.Response:
+        """POST an STK push request, refreshing the token once if Daraja rejects it."""
+        for attempt in range(2):
+            access_token = await self.get_access_token()
+            response = await self.http.post(
+                "/mpesa/stkpush/v1/processrequest",
+                json=payload,
+                headers={"Authorization": f"Bearer {access_token}"},
+            )
+            if response.status_code != 401 or attempt:
+                return response
+            self.invalidate_token()
+        return response
+
+    async def close(self):
+        if self._http is not None:
+            await self._http.aclose()
+            self._http = None
+
+
+DARAJA_CLIENT = DarajaClient(MPESA_BASE_URL, MPESA_CONSUMER_KEY, MPESA_CONSUMER_SECRET)
+
+
+async def get_access_token() -> str:
+    """
+    Generate OAuth access token for M-Pesa Daraja API (async, cached)
+    """
+    return await DARAJA_CLIENT.get_access_token()
 
 
 def generate_password(shortcode: str, passkey: str, timestamp: str) -> str:
@@ -51,16 +133,9 @@ async def initiate_stk_push(payment) -> dict:
     """
     Trigger M-Pesa STK Push
     """
-    access_token = await get_access_token()
     timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
     password = generate_password(MPESA_SHORTCODE, MPESA_PASSKEY, timestamp)
 
-    stk_url = f"{MPESA_BASE_URL}/mpesa/stkpush/v1/processrequest"
-    headers = {
-        "Authorization": f"Bearer {access_token}",
-        "Content-Type": "application/json"
-    }
-
     payload = {
         "BusinessShortCode": MPESA_SHORTCODE,
         "Password": password,
@@ -75,8 +150,7 @@ async def initiate_stk_push(payment) -> dict:
         "TransactionDesc": "Glow Haven Beauty Lounge Booking Payment"
     }
 
-    async with aiohttp.ClientSession() as session:
-        async with session.post(stk_url, json=payload, headers=headers) as response:
-            resp_data = await response.json()
-            print(f"📤 STK Push ({response.status}): {resp_data}")
-            return resp_data
+    response = await DARAJA_CLIENT.stk_push(payload)
+    resp_data = response.json()
+    print(f"📤 STK Push ({response.status_code}): {resp_data}")
+    return resp_data
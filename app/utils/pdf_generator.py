@@ -1,21 +1,272 @@
-
 # app/utils/pdf_generator.py
+import asyncio
+import hashlib
+import io
+import json
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from pathlib import Path
+
 from reportlab.lib.pagesizes import A4
 from reportlab.pdfgen import canvas
-from datetime import datetime
 
-def generate_receipt_pdf(booking, payment):
-    filename = f"receipt_{booking.id}.pdf"
-    c = canvas.Canvas(filename, pagesize=A4)
-    c.setFont("Helvetica-Bold", 16)
-    c.drawString(100, 800, "Glow Haven Beauty Lounge - Receipt")
-    c.setFont("Helvetica", 12)
-    c.drawString(100, 770, f"Customer: {booking.customer_name}")
-    c.drawString(100, 750, f"Service: {booking.service_name}")
-    c.drawString(100, 730, f"Date: {booking.date} {booking.time}")
-    c.drawString(100, 710, f"Amount Paid: KES {payment.amount}")
-    c.drawString(100, 690, f"Transaction ID: {payment.transaction_id}")
-    c.drawString(100, 670, f"Status: {booking.status}")
-    c.drawString(100, 650, f"Issue Date: {datetime.now().strftime('%Y-%m-%d %H:%M')}")
+RECEIPTS_DIR = Path(os.getenv("RECEIPTS_DIR", "receipts"))
+
+BUSINESS_NAME = "Glow Haven Beauty Lounge"
+FOOTER_LINES = (
+    "Thank you for choosing Glow Haven Beauty Lounge!",
+    "For inquiries: info@glowhavenbeauty.co.ke | +254 712 345 678",
+)
+TEMPLATE_NAME = "receipt_template"
+
+
+# ---------------- receipt fields ----------------
+
+def _fmt_datetime(value) -> str:
+    if isinstance(value, datetime):
+        return value.strftime("%Y-%m-%d %H:%M:%S")
+    return str(value) if value else "N/A"
+
+
+def receipt_fields(booking, payment) -> dict:
+    """Everything printed on a receipt for a Booking/Payment row, as plain strings."""
+    return {
+        "title": "Payment Receipt",
+        "details": [
+            ("Date:", _fmt_datetime(payment.created_at)),
+            ("Booking ID:", str(booking.id)),
+            ("Customer Name:", booking.customer_name),
+            ("Phone Number:", payment.phone_number),
+            ("Service:", booking.service_name),
+            ("Appointment:", f"{booking.date} {booking.time}"),
+            ("Amount Paid:", f"KES {payment.amount:.2f}"),
+            ("M-Pesa Receipt Number:", payment.transaction_id or "N/A"),
+            ("Status:", payment.status),
+        ],
+    }
+
+
+def receipt_key(fields: dict) -> str:
+    """Content address of a receipt: the same fields always render the same PDF."""
+    canonical = json.dumps(fields, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+# ---------------- rendering ----------------
+
+def _ensure_template(c: canvas.Canvas):
+    """Draw the static header/footer once per document as a reusable form."""
+    if getattr(c, "_receipt_template", False):
+        return
+    width, height = A4
+    c.beginForm(TEMPLATE_NAME)
+    c.setFont("Helvetica-Bold", 20)
+    c.drawCentredString(width / 2, height - 50, BUSINESS_NAME)
+    c.line(30, height - 80, width - 30, height - 80)
+    c.line(30, 100, width - 30, 100)
+    c.setFont("Helvetica-Oblique", 10)
+    c.drawCentredString(width / 2, 80, FOOTER_LINES[0])
+    c.drawCentredString(width / 2, 65, FOOTER_LINES[1])
+    c.endForm()
+    c._receipt_template = True
+
+
+def draw_receipt_page(c: canvas.Canvas, fields: dict):
+    """Draw one receipt on the current page of `c` and end the page."""
+    _ensure_template(c)
+    width, height = A4
+    c.doForm(TEMPLATE_NAME)
+
+    c.setFont("Helvetica", 14)
+    c.drawCentredString(width / 2, height - 70, fields.get("title", "Payment Receipt"))
+
+    c.setFont("Helvetica-Bold", 12)
+    y = height - 120
+    c.drawString(40, y, "Receipt Details:")
+    y -= 20
+    for label, value in fields["details"]:
+        c.setFont("Helvetica-Bold", 11)
+        c.drawString(40, y, label)
+        c.setFont("Helvetica", 11)
+        c.drawString(180, y, str(value))
+        y -= 20
+    c.showPage()
+
+
+def render_receipt(fields: dict) -> bytes:
+    """Render a single-page receipt PDF. Pure function, safe to run in a worker process."""
+    buffer = io.BytesIO()
+    c = canvas.Canvas(buffer, pagesize=A4, invariant=1)
+    c.setTitle(f"{BUSINESS_NAME} - {fields.get('title', 'Receipt')}")
+    draw_receipt_page(c, fields)
     c.save()
-    return filename
+    return buffer.getvalue()
+
+
+def render_receipts(fields_list: list[dict]) -> list[bytes]:
+    """Render several single-page receipts in one worker call."""
+    return [render_receipt(fields) for fields in fields_list]
+
+
+def render_statement(fields_list: list[dict], path: str, title: str = "Receipts Statement") -> int:
+    """
+    Write every receipt as one page of a single PDF at `path`. The header and
+    footer form is drawn once and reused by every page. Returns the page count.
+    """
+    c = canvas.Canvas(path, pagesize=A4, invariant=1, pageCompression=1)
+    c.setTitle(f"{BUSINESS_NAME} - {title}")
+    for fields in fields_list:
+        draw_receipt_page(c, fields)
+    if not fields_list:
+        c.setFont("Helvetica", 12)
+        c.drawString(40, A4[1] - 60, "No receipts match the selected filters.")
+        c.showPage()
+    c.save()
+    return max(1, len(fields_list))
+
+
+class ReceiptRenderer:
+    """
+    Renders receipts in a bounded process pool, off the event loop.
+    PDFs are stored under `cache_dir` by receipt_key(fields), so a receipt
+    with unchanged fields is rendered once and then served from disk.
+    Concurrent requests for the same receipt share one render.
+    Workers are started with forkserver (spawn where unavailable), so they
+    never inherit the app's event loop, threads or open connections.
+    """
+
+    def __init__(self, cache_dir: str | Path = RECEIPTS_DIR, max_workers: int = 2):
+        self.cache_dir = Path(cache_dir)
+        self.max_workers = max(1, max_workers)
+        self._pool: ProcessPoolExecutor | None = None
+        self._in_flight: dict[str, asyncio.Future] = {}
+        self.renders = 0
+        self.cache_hits = 0
+
+    @property
+    def pool(self) -> ProcessPoolExecutor:
+        if self._pool is None:
+            methods = multiprocessing.get_all_start_methods()
+            context = multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+            self._pool = ProcessPoolExecutor(max_workers=self.max_workers, mp_context=context)
+        return self._pool
+
+    def path_for(self, key: str) -> Path:
+        return self.cache_dir / f"{key}.pdf"
+
+    def _store(self, key: str, data: bytes) -> Path:
+        path = self.path_for(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_suffix(f".{os.getpid()}.tmp")
+        tmp.write_bytes(data)
+        os.replace(tmp, path)  # atomic, readers never see a partial file
+        return path
+
+    async def render(self, fields: dict) -> tuple[str, Path]:
+        """Return (key, path) of the receipt PDF, rendering it if not cached."""
+        key = receipt_key(fields)
+        path = self.path_for(key)
+        if path.exists():
+            self.cache_hits += 1
+            return key, path
+
+        pending = self._in_flight.get(key)
+        if pending is not None:
+            return key, await asyncio.shield(pending)
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._in_flight[key] = future
+        try:
+            data = await loop.run_in_executor(self.pool, render_receipt, fields)
+            path = await asyncio.to_thread(self._store, key, data)
+            self.renders += 1
+            future.set_result(path)
+            return key, path
+        except BaseException as e:
+            future.set_exception(e)
+            future.exception()  # mark retrieved when nobody else is waiting
+            raise
+        finally:
+            del self._in_flight[key]
+
+    async def render_batch(self, fields_list: list[dict]) -> list[bytes]:
+        """
+        PDF bytes for each receipt: cached ones are read, the rest rendered in
+        one pool call per worker. Receipts already being rendered by another
+        caller are waited for rather than rendered again.
+        """
+        keys = [receipt_key(fields) for fields in fields_list]
+
+        def read_cached():
+            cached = {}
+            for key in keys:
+                try:
+                    cached[key] = self.path_for(key).read_bytes()
+                except FileNotFoundError:
+                    pass
+            return cached
+
+        results = await asyncio.to_thread(read_cached)
+        self.cache_hits += len(results)
+        missing = {key: fields for key, fields in zip(keys, fields_list) if key not in results}
+        pending = {key: self._in_flight[key] for key in missing if key in self._in_flight}
+        todo = {key: fields for key, fields in missing.items() if key not in pending}
+
+        if todo:
+            loop = asyncio.get_running_loop()
+            futures = {key: loop.create_future() for key in todo}
+            self._in_flight.update(futures)
+            try:
+                items = list(todo.values())
+                # One slice per worker so a batch uses the whole pool
+                step = -(-len(items) // self.max_workers)
+                parts = await asyncio.gather(*(
+                    loop.run_in_executor(self.pool, render_receipts, items[i:i + step])
+                    for i in range(0, len(items), step)
+                ))
+                rendered = dict(zip(todo, (data for part in parts for data in part)))
+                paths = await asyncio.to_thread(lambda: {k: self._store(k, d) for k, d in rendered.items()})
+                self.renders += len(rendered)
+                results.update(rendered)
+                for key, future in futures.items():
+                    future.set_result(paths[key])
+            except BaseException as e:
+                for future in futures.values():
+                    future.set_exception(e)
+                    future.exception()  # mark retrieved when nobody else is waiting
+                raise
+            finally:
+                for key in futures:
+                    del self._in_flight[key]
+
+        if pending:
+            paths = await asyncio.gather(*(asyncio.shield(future) for future in pending.values()))
+            results.update(await asyncio.to_thread(
+                lambda: {key: path.read_bytes() for key, path in zip(pending, paths)}
+            ))
+        return [results[key] for key in keys]
+
+    async def render_statement(self, fields_list: list[dict], path: str | Path) -> int:
+        """Render a multi-page statement to `path` in the pool; returns the page count."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.pool, render_statement, fields_list, str(path))
+
+    def snapshot(self) -> dict:
+        return {
+            "renders": self.renders,
+            "cache_hits": self.cache_hits,
+            "in_flight": len(self._in_flight),
+            "workers": self.max_workers,
+        }
+
+    async def close(self):
+        if self._pool is not None:
+            pool, self._pool = self._pool, None
+            # Waiting for workers to exit would otherwise block the event loop
+            await asyncio.to_thread(pool.shutdown, wait=True, cancel_futures=True)
+
+
+RECEIPT_RENDERER = ReceiptRenderer(max_workers=int(os.getenv("RECEIPT_WORKERS", "2")))
@@ -0,0 +1,57 @@
+# app/utils/signed_urls.py
+import hashlib
+import hmac
+import logging
+import os
+import re
+import secrets
+import time
+from urllib.parse import urlencode
+
+logger = logging.getLogger("signed_urls")
+
+# Public origin of this API, used to build links customers (and Twilio) can open
+PUBLIC_BASE_URL = os.getenv("PUBLIC_BASE_URL", "http://localhost:9000").rstrip("/")
+RECEIPT_URL_TTL = int(os.getenv("RECEIPT_URL_TTL", str(7 * 24 * 3600)))
+
+_secret = os.getenv("RECEIPT_URL_SECRET")
+if not _secret:
+    # Links still work, but only in this process and only until it restarts
+    logger.warning("RECEIPT_URL_SECRET is not set; using a temporary secret for receipt links")
+    _secret = secrets.token_hex(32)
+RECEIPT_URL_SECRET = _secret.encode()
+
+# What sign() produces; anything else is rejected before comparing
+SIGNATURE = re.compile(r"[0-9a-f]{64}")
+
+
+def sign(path: str, expires: int) -> str:
+    message = f"{path}:{expires}".encode()
+    return hmac.new(RECEIPT_URL_SECRET, message, hashlib.sha256).hexdigest()
+
+
+def verify(path: str, expires: int, signature: str) -> str | None:
+    """Return None if the signature is valid and unexpired, else the reason it is not."""
+    if not SIGNATURE.fullmatch(signature) or not hmac.compare_digest(
+        sign(path, expires).encode(), signature.encode()
+    ):
+        return "invalid"
+    if expires < time.time():
+        return "expired"
+    return None
+
+
+def signed_url(path: str, ttl: int = RECEIPT_URL_TTL) -> tuple[str, int]:
+    """Absolute URL for `path` that stays valid for `ttl` seconds; returns (url, expires)."""
+    expires = int(time.time()) + ttl
+    query = urlencode({"expires": expires, "sig": sign(path, expires)})
+    return f"{PUBLIC_BASE_URL}{path}?{query}", expires
+
+
+def receipt_path(key: str) -> str:
+    return f"/api/receipts/download/{key}.pdf"
+
+
+def receipt_url(key: str, ttl: int = RECEIPT_URL_TTL) -> tuple[str, int]:
+    """Signed download link for the cached receipt with content key `key`."""
+    return signed_url(receipt_path(key), ttl)
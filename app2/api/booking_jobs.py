@@ -0,0 +1,235 @@
+import asyncio
+import os
+import uuid
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+from app.utils.signed_urls import receipt_url
+from .utils import (
+    db, initiate_payment, find_payment_request, poll_payment_status, generate_receipt, add_booking_to_db,
+)
+from .google_calendar import add_to_calendar
+
+jobs_collection = db["booking_jobs"]
+
+# How long a customer has to approve the STK push on their phone
+PAYMENT_TIMEOUT = int(os.getenv("BOOKING_PAYMENT_TIMEOUT", "120"))
+# Attempts per step before the job fails (payment waits are not retried)
+JOB_MAX_ATTEMPTS = int(os.getenv("BOOKING_JOB_MAX_ATTEMPTS", "3"))
+
+# Job states, in order. Each non-final state names the step that runs next.
+CREATED = "created"
+PAYMENT_REQUESTING = "payment_requesting"
+PAYMENT_REQUESTED = "payment_requested"
+PAID = "paid"
+RECEIPT_GENERATED = "receipt_generated"
+BOOKED = "booked"
+COMPLETED = "completed"
+FAILED = "failed"
+FINAL_STATES = (COMPLETED, FAILED)
+
+
+class JobFailed(Exception):
+    """A step failed in a way retrying won't fix."""
+
+
+async def _prepare_payment(job: dict) -> tuple[str, dict]:
+    # Persisted before anything is sent, so the push below can be reconciled after a restart
+    return PAYMENT_REQUESTING, {"payment_request_id": uuid.uuid4().hex}
+
+
+async def _request_payment(job: dict) -> tuple[str, dict]:
+    payment = await find_payment_request(job["payment_request_id"])
+    if payment is None:
+        # Never attempted (or Daraja refused it): safe to push
+        pushed = await initiate_payment(job["phone_number"], job["amount"], request_id=job["payment_request_id"])
+        if not pushed["id"]:
+            raise JobFailed("Payment initiation failed")
+        checkout_request_id, requested_at = pushed["id"], datetime.now(timezone.utc)
+    elif payment.get("checkout_request_id"):
+        # Pushed before a restart or retry: wait on that request instead of sending another
+        checkout_request_id, requested_at = payment["checkout_request_id"], payment["created_at"]
+        if requested_at.tzinfo is None:
+            requested_at = requested_at.replace(tzinfo=timezone.utc)
+    else:
+        # Interrupted before Daraja answered; the customer may already have a prompt
+        raise JobFailed("Payment request interrupted; not repeated to avoid a double charge")
+    deadline = requested_at + timedelta(seconds=PAYMENT_TIMEOUT)
+    return PAYMENT_REQUESTED, {"checkout_request_id": checkout_request_id, "payment_deadline": deadline}
+
+
+async def _await_payment(job: dict) -> tuple[str, dict]:
+    # After a restart only the remaining time is waited; a callback that
+    # arrived meanwhile is found by the first status check
+    deadline = job["payment_deadline"]
+    if deadline.tzinfo is None:  # Mongo returns naive UTC datetimes
+        deadline = deadline.replace(tzinfo=timezone.utc)
+    remaining = max(0.0, (deadline - datetime.now(timezone.utc)).total_seconds())
+    status = await poll_payment_status(job["checkout_request_id"], timeout=remaining)
+    if status != "success":
+        raise JobFailed("Payment failed or timed out")
+    return PAID, {}
+
+
+async def _generate_receipt(job: dict) -> tuple[str, dict]:
+    path = await generate_receipt(job["checkout_request_id"], job["customer_name"], job["service_name"])
+    return RECEIPT_GENERATED, {"receipt_path": path, "receipt_key": Path(path).stem}
+
+
+async def _save_booking(job: dict) -> tuple[str, dict]:
+    booking = await add_booking_to_db(
+        job["customer_name"], job["phone_number"], job["service_name"],
+        job["date"], job["time"], job["amount"], job_id=job["_id"],
+    )
+    return BOOKED, {"booking": booking}
+
+
+async def _add_to_calendar(job: dict) -> tuple[str, dict]:
+    link = await add_to_calendar(
+        job["customer_name"], job["date"], job["time"], job["service_name"], event_id=job["_id"],
+    )
+    return COMPLETED, {"calendar_link": link}
+
+
+STEPS = {
+    CREATED: _prepare_payment,
+    PAYMENT_REQUESTING: _request_payment,
+    PAYMENT_REQUESTED: _await_payment,
+    PAID: _generate_receipt,
+    RECEIPT_GENERATED: _save_booking,
+    BOOKED: _add_to_calendar,
+}
+
+
+class BookingJobRunner:
+    """
+    Runs booking flows as persisted state machines.
+    Every transition is written to the `booking_jobs` collection before the
+    next step starts, so after a restart `resume()` continues each
+    unfinished job from its last completed step. Steps are idempotent:
+    the STK push is keyed by a request id saved before it is sent, and the
+    booking insert and calendar event by the job id.
+    Failures to load or save a job are retried with backoff in place, so
+    the step re-runs and the job keeps going once MongoDB answers again.
+    A job waiting on a customer's phone is just a sleeping task.
+    Only one app2 process should run jobs against a database.
+    """
+
+    def __init__(self, collection=jobs_collection, max_attempts: int = JOB_MAX_ATTEMPTS, retry_backoff: float = 2.0):
+        self.collection = collection
+        self.max_attempts = max_attempts
+        self.retry_backoff = retry_backoff
+        self._tasks: dict[str, asyncio.Task] = {}
+
+    async def submit(self, customer_name, phone_number, service_name, date, time, amount) -> dict:
+        now = datetime.now(timezone.utc)
+        job = {
+            "_id": uuid.uuid4().hex,
+            "state": CREATED,
+            "customer_name": customer_name,
+            "phone_number": phone_number,
+            "service_name": service_name,
+            "date": date,
+            "time": time,
+            "amount": amount,
+            "attempts": 0,
+            "error": None,
+            "created_at": now,
+            "updated_at": now,
+        }
+        await self.collection.insert_one(job)
+        self._spawn(job["_id"])
+        return job
+
+    async def get(self, job_id: str) -> dict | None:
+        return await self.collection.find_one({"_id": job_id})
+
+    async def resume(self) -> int:
+        """Restart every unfinished job; returns how many were resumed."""
+        resumed = 0
+        async for job in self.collection.find({"state": {"$nin": list(FINAL_STATES)}}, {"_id": 1}):
+            self._spawn(job["_id"])
+            resumed += 1
+        return resumed
+
+    def _spawn(self, job_id: str):
+        if job_id in self._tasks:
+            return
+        task = asyncio.create_task(self._run(job_id))
+        self._tasks[job_id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(job_id, None))
+
+    async def _update(self, job_id: str, fields: dict):
+        fields["updated_at"] = datetime.now(timezone.utc)
+        await self.collection.update_one({"_id": job_id}, {"$set": fields})
+
+    async def _run(self, job_id: str):
+        # Saving or reloading the job can fail transiently (AutoReconnect,
+        # timeouts); back off and continue from what is stored rather than
+        # let the task die with the job stuck until the next restart
+        delay = self.retry_backoff
+        while True:
+            try:
+                finished = await self._advance(job_id)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Booking job {job_id}: could not load or save state, retrying in {delay:.0f}s: {e}")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 60.0)
+                continue
+            if finished:
+                return
+            delay = self.retry_backoff
+
+    async def _advance(self, job_id: str) -> bool:
+        """Run the job's next step and persist the outcome; True once there is nothing left to run."""
+        job = await self.get(job_id)
+        if not job or job["state"] in FINAL_STATES:
+            return True
+        step = STEPS[job["state"]]
+        try:
+            state, fields = await step(job)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            attempts = job.get("attempts", 0) + 1
+            if isinstance(e, JobFailed) or attempts >= self.max_attempts:
+                print(f"Booking job {job_id} failed in {job['state']}: {e}")
+                await self._update(job_id, {"state": FAILED, "failed_step": job["state"], "error": str(e)})
+                return True
+            await self._update(job_id, {"attempts": attempts, "error": str(e)})
+            await asyncio.sleep(self.retry_backoff * 2 ** (attempts - 1))
+        else:
+            await self._update(job_id, {"state": state, "attempts": 0, "error": None, **fields})
+        return False
+
+    async def close(self):
+        """Stop running jobs; they are picked up again by the next resume()."""
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def job_view(job: dict) -> dict:
+    """Public representation of a job document."""
+    return {
+        "job_id": job["_id"],
+        "state": job["state"],
+        "done": job["state"] in FINAL_STATES,
+        "service_name": job["service_name"],
+        "amount": job["amount"],
+        "checkout_request_id": job.get("checkout_request_id"),
+        # Fresh signed link on every read; the key names the cached PDF
+        "receipt_url": receipt_url(job["receipt_key"])[0] if job.get("receipt_key") else None,
+        "booking": job.get("booking"),
+        "calendar_link": job.get("calendar_link"),
+        "error": job.get("error"),
+        "failed_step": job.get("failed_step"),
+        "created_at": job["created_at"].isoformat(),
+        "updated_at": job["updated_at"].isoformat(),
+    }
+
+
+BOOKING_JOBS = BookingJobRunner()
@@ -1,33 +1,61 @@
 
 import datetime
 import asyncio
+import os
+import threading
 from google.oauth2 import service_account
 from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
 
 # Path to your JSON key file
-SERVICE_ACCOUNT_FILE = "google_cred.json"
+SERVICE_ACCOUNT_FILE = os.getenv("GOOGLE_APPLICATION_CREDENTIALS", "google_cred.json")
 
 # The ID of your shared Google Calendar
-CALENDAR_ID = "mwangiboyle4@gmail.com"
+CALENDAR_ID = os.getenv("GOOGLE_CALENDAR_ID", "mwangiboyle4@gmail.com")
 
 # Define scope
 SCOPES = ["https://www.googleapis.com/auth/calendar"]
 
-# Authenticate with service account
-credentials = service_account.Credentials.from_service_account_file(
-    SERVICE_ACCOUNT_FILE, scopes=SCOPES
-)
+_credentials = None
+_credentials_lock = threading.Lock()
+# Calendar services are not thread-safe; one per worker thread, built on first use
+_local = threading.local()
 
-# Optional: Impersonate the calendar owner (if needed)
-# credentials = credentials.with_subject("your_business_email@gmail.com")
 
-service = build("calendar", "v3", credentials=credentials)
+def get_calendar_service():
+    """Service for the calling thread; credentials are loaded once per process."""
+    global _credentials
+    service = getattr(_local, "service", None)
+    if service is None:
+        with _credentials_lock:
+            if _credentials is None:
+                # Authenticate with service account
+                _credentials = service_account.Credentials.from_service_account_file(
+                    SERVICE_ACCOUNT_FILE, scopes=SCOPES
+                )
+                # Optional: Impersonate the calendar owner (if needed)
+                # _credentials = _credentials.with_subject("your_business_email@gmail.com")
+        service = build("calendar", "v3", credentials=_credentials, cache_discovery=False)
+        _local.service = service
+    return service
 
 
-async def add_to_calendar(customer_name: str, date: str, time: str, service_name: str):
+def _insert_event(event: dict, event_id: str | None) -> dict:
+    service = get_calendar_service()
+    try:
+        return service.events().insert(calendarId=CALENDAR_ID, body=event).execute()
+    except HttpError as e:
+        if not event_id or e.resp.status != 409:
+            raise
+        # Already created by an earlier attempt
+        return service.events().get(calendarId=CALENDAR_ID, eventId=event_id).execute()
+
+
+async def add_to_calendar(customer_name: str, date: str, time: str, service_name: str, event_id: str | None = None):
     """
     Adds a booking to the shared business calendar using a service account.
     Returns a public Google Calendar link.
+    An `event_id` (lowercase hex/base32hex) makes retries return the existing event.
     """
     booking_date = datetime.datetime.strptime(f"{date} {time}", "%Y-%m-%d %H:%M")
     end_time = booking_date + datetime.timedelta(hours=1)
@@ -53,7 +81,10 @@ async def add_to_calendar(customer_name: str, date: str, time: str, service_name
         },
     }
 
-    event_result = service.events().insert(calendarId=CALENDAR_ID, body=event).execute()
+    if event_id:
+        event["id"] = event_id
+    # The client library blocks; keep it off the event loop
+    event_result = await asyncio.to_thread(_insert_event, event, event_id)
     return event_result.get("htmlLink")
 
 
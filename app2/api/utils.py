@@ -1,17 +1,17 @@
-import json
-import httpx
 import os
 from datetime import datetime, timezone
 from base64 import b64encode
 import asyncio
+import httpx
 from dotenv import load_dotenv
 from motor.motor_asyncio import AsyncIOMotorClient
-from reportlab.lib.pagesizes import A4
-from reportlab.lib import colors
-from reportlab.lib.units import mm
-from reportlab.pdfgen import canvas
+from pymongo import ReturnDocument
 from datetime import datetime
 import os
+from app.catalog import CATALOG
+from app.utils.mpesa import DARAJA_CLIENT
+from app.payment_events import PAYMENT_EVENTS, FINAL_STATUSES
+from app.utils.pdf_generator import RECEIPT_RENDERER
 
 MONGO_URI = "mongodb://localhost:27017"  # or your cloud URI
 DB_NAME = "glowhaven"
@@ -27,21 +27,30 @@ payments = {}
 
 async def check_service(service_name: str) -> bool:
     """
-    Check if a service exists in the services.json file.
+    Check if a service exists in the business catalog.
 
     :param service_name: Name of the service to check
     :return: True if service exists, False otherwise
     """
-    # Load the JSON data from a file
-    with open("business.json", "r", encoding="utf-8") as f:
-        data = json.load(f)
+    return CATALOG.get_item(service_name) is not None
 
-    # Search for the service
-    for category in data.get("services", []):
-        for item in category.get("items", []):
-            if item.get("name", "").lower() == service_name.lower():
-                return True
-    return False
+
+async def resolve_service_name(service_name: str) -> tuple[str | None, list[dict]]:
+    """
+    Resolve a customer's wording to a catalog service name.
+
+    :param service_name: Name as typed by the customer
+    :return: (canonical name or None if no confident match, ranked candidates)
+    """
+    matches = CATALOG.resolve(service_name)
+    if not matches:
+        return None, matches
+    top = matches[0]
+    runner_up = matches[1]["score"] if len(matches) > 1 else 0.0
+    # Accept a strong match, or a reasonable one that clearly beats the next
+    if top["score"] >= 0.75 or (top["score"] >= 0.5 and top["score"] - runner_up >= 0.15):
+        return top["name"], matches
+    return None, matches
 
 
 async def calculate_payment(service_name: str) -> float:
@@ -52,43 +61,31 @@ async def calculate_payment(service_name: str) -> float:
     :return: 30% of the service price
     :raises ValueError: If service not found
     """
-    # Load the JSON data
-    with open("business.json", "r", encoding="utf-8") as f:
-        data = json.load(f)
-
-    # Search for the service
-    for category in data.get("services", []):
-        for item in category.get("items", []):
-            if item.get("name", "").lower() == service_name.lower():
-                price = item.get("price", 0)
-                return round(price * 0.3, 2)  # 30% deposit, rounded to 2 decimals
+    item = CATALOG.get_item(service_name)
+    if item is None:
+        raise ValueError(f"Service '{service_name}' not found.")
+    price = item.get("price", 0)
+    return round(price * 0.3, 2)  # 30% deposit, rounded to 2 decimals
 
-    raise ValueError(f"Service '{service_name}' not found.")
 
 
 
-
-DARAJA_BASE_URL = "https://sandbox.safaricom.co.ke"
-CONSUMER_KEY = os.getenv("MPESA_CONSUMER_KEY")
-CONSUMER_SECRET = os.getenv("MPESA_CONSUMER_SECRET")
 BUSINESS_SHORT_CODE = os.getenv("DARJA_SHORTCODE", "174379")
 PASSKEY = os.getenv("MPESA_PASSKEY")
 CALLBACK_URL = "https://195404c71073.ngrok-free.app/daraja/callback"
 
 async def get_access_token():
-    auth = (CONSUMER_KEY, CONSUMER_SECRET)
-    async with httpx.AsyncClient() as client:
-        res = await client.get(
-            f"{DARAJA_BASE_URL}/oauth/v1/generate?grant_type=client_credentials",
-            auth=auth,
-        )
-        res.raise_for_status()
-        return res.json()["access_token"]
-
+    # Cached, single-flight token shared with the main app's Daraja client
+    return await DARAJA_CLIENT.get_access_token()
 
-async def initiate_payment(phone_number: str, amount: float):
-    access_token = await get_access_token()
 
+async def initiate_payment(phone_number: str, amount: float, request_id: str | None = None):
+    """
+    Send an STK push and record the pending payment.
+    With `request_id` the payment record is written before the push, so a
+    caller interrupted mid-request can tell (find_payment_request) whether
+    the push may have gone out instead of sending a second one.
+    """
     timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
     import base64
     password = base64.b64encode(f"{BUSINESS_SHORT_CODE}{PASSKEY}{timestamp}".encode()).decode()
@@ -107,18 +104,42 @@ async def initiate_payment(phone_number: str, amount: float):
         "TransactionDesc": "Booking deposit",
     }
 
-    headers = {"Authorization": f"Bearer {access_token}"}
+    if request_id:
+        await payments_collection.update_one(
+            {"request_id": request_id},
+            {"$setOnInsert": {
+                "request_id": request_id,
+                "phone": phone_number,
+                "amount": amount,
+                "status": "requesting",
+                "created_at": datetime.now(timezone.utc),
+            }},
+            upsert=True,
+        )
 
-    async with httpx.AsyncClient() as client:
-        res = await client.post(f"{DARAJA_BASE_URL}/mpesa/stkpush/v1/processrequest", json=payload, headers=headers)
+    try:
+        res = await DARAJA_CLIENT.stk_push(payload)
         res.raise_for_status()
-        data = res.json()
+    except httpx.HTTPStatusError:
+        # Daraja answered with an error: nothing was pushed, a retry is safe
+        if request_id:
+            await payments_collection.delete_one({"request_id": request_id, "status": "requesting"})
+        raise
+    data = res.json()
 
     checkout_id = data.get("CheckoutRequestID")
 
 
 # ✅ Save pending record to MongoDB
-    if checkout_id:
+    if request_id:
+        if checkout_id:
+            await payments_collection.update_one(
+                {"request_id": request_id},
+                {"$set": {"checkout_request_id": checkout_id, "status": "pending"}},
+            )
+        else:
+            await payments_collection.delete_one({"request_id": request_id, "status": "requesting"})
+    elif checkout_id:
         await payments_collection.insert_one({
             "checkout_request_id": checkout_id,
             "phone": phone_number,
@@ -131,18 +152,47 @@ async def initiate_payment(phone_number: str, amount: float):
     return {"id": checkout_id, "raw": data}
 
 
+async def find_payment_request(request_id: str) -> dict | None:
+    """The payment recorded by initiate_payment(..., request_id=request_id), if any."""
+    return await payments_collection.find_one({"request_id": request_id})
+
+
 async def poll_payment_status(checkout_request_id: str, timeout: int = 60):
-    """Poll MongoDB until payment is success/failed or timeout."""
-    for _ in range(timeout // 5):
-        payment = await payments_collection.find_one({"checkout_request_id": checkout_request_id})
-        if payment:
-            status = payment.get("status")
-            if status == "success":
-                return "success"
-            elif status == "failed":
-                return "failed"
-        await asyncio.sleep(5)
-    return "pending"
+    """
+    Wait until the payment is success/failed or timeout.
+    The callback wakes waiters in this process immediately. Callbacks handled
+    elsewhere are seen via the change stream watcher or a slow poll.
+    """
+    async def check():
+        payment = await payments_collection.find_one(
+            {"checkout_request_id": checkout_request_id}, {"status": 1}
+        )
+        status = payment.get("status") if payment else None
+        return status if status in FINAL_STATUSES else None
+
+    status = await PAYMENT_EVENTS.wait(checkout_request_id, timeout, check=check)
+    return status or "pending"
+
+
+async def watch_payment_updates():
+    """
+    Publish payment outcomes written by other processes via a MongoDB change
+    stream. Change streams need a replica set; without one, waiters keep
+    falling back to the slow poll.
+    """
+    pipeline = [{"$match": {
+        "operationType": {"$in": ["insert", "update", "replace"]},
+        "fullDocument.status": {"$in": list(FINAL_STATUSES)},
+    }}]
+    try:
+        async with payments_collection.watch(pipeline, full_document="updateLookup") as stream:
+            async for change in stream:
+                doc = change["fullDocument"]
+                PAYMENT_EVENTS.publish(doc["checkout_request_id"], doc["status"])
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        print("Payment change stream unavailable, polling instead:", e)
 
 async def save_callback_data(data: dict):
     try:
@@ -192,7 +242,8 @@ async def save_callback_data(data: dict):
 async def generate_receipt(checkout_request_id: str, customer_name: str, service_name: str) -> str:
     """
     Generate a styled PDF receipt for a completed payment.
-    Fetches payment info from MongoDB using checkout_request_id.
+    Fetches payment info from MongoDB using checkout_request_id; the PDF is
+    rendered by the shared receipt renderer (process pool, cached by content).
     """
 
     # 1️⃣ Fetch payment record from MongoDB
@@ -207,64 +258,30 @@ async def generate_receipt(checkout_request_id: str, customer_name: str, service
     mpesa_receipt = payment.get("receipt_number", "N/A")
     transaction_date = payment.get("created_at")
 
-    # 3️⃣ Create receipts folder
-    os.makedirs("receipts", exist_ok=True)
-    filename = f"receipts/receipt_{checkout_request_id}.pdf"
-
-    # 4️⃣ Create PDF
-    c = canvas.Canvas(filename, pagesize=A4)
-    width, height = A4
-
-    # ----- HEADER -----
-    c.setFont("Helvetica-Bold", 20)
-    c.drawCentredString(width / 2, height - 50, "Glow Haven Beauty Lounge")
-
-    c.setFont("Helvetica", 14)
-    c.drawCentredString(width / 2, height - 70, "Payment Receipt")
-
-    c.line(30, height - 80, width - 30, height - 80)
-
-    # ----- PAYMENT DETAILS -----
-    c.setFont("Helvetica-Bold", 12)
-    y = height - 120
-    c.drawString(40, y, "Receipt Details:")
-    y -= 20
-
-    # Table-like layout
-    c.setFont("Helvetica", 11)
-    details = [
-        ("Date:", transaction_date or datetime.now().strftime("%Y-%m-%d %H:%M:%S")),
-        ("Customer Name:", customer_name),
-        ("Phone Number:", phone),
-        ("Service:", service_name),
-        ("Amount Paid:", f"KES {amount:.2f}"),
-        ("M-Pesa Receipt Number:", mpesa_receipt),
-        ("Checkout Request ID:", checkout_request_id),
-    ]
-
-    for label, value in details:
-        c.setFont("Helvetica-Bold", 11)
-        c.drawString(40, y, label)
-        c.setFont("Helvetica", 11)
-        c.drawString(180, y, str(value))
-        y -= 20
-
-    # ----- FOOTER -----
-    c.line(30, 100, width - 30, 100)
-    c.setFont("Helvetica-Oblique", 10)
-    c.drawCentredString(width / 2, 80, "Thank you for choosing Glow Haven Beauty Lounge!")
-    c.drawCentredString(width / 2, 65, "For inquiries: info@glowhavenbeauty.co.ke | +254 712 345 678")
-
-    # 5️⃣ Save PDF
-    c.showPage()
-    c.save()
-
-    return filename
-
-
-async def add_booking_to_db(customer_name: str, phone: str, service: str, date: str, time: str, amount: float):
+    fields = {
+        "title": "Payment Receipt",
+        "details": [
+            ("Date:", transaction_date.strftime("%Y-%m-%d %H:%M:%S")
+                      if isinstance(transaction_date, datetime) else str(transaction_date or "N/A")),
+            ("Customer Name:", customer_name),
+            ("Phone Number:", str(phone)),
+            ("Service:", service_name),
+            ("Amount Paid:", f"KES {amount:.2f}"),
+            ("M-Pesa Receipt Number:", str(mpesa_receipt)),
+            ("Checkout Request ID:", checkout_request_id),
+        ],
+    }
+
+    # 3️⃣ Render (or reuse) the PDF
+    _, path = await RECEIPT_RENDERER.render(fields)
+    return str(path)
+
+
+async def add_booking_to_db(customer_name: str, phone: str, service: str, date: str, time: str, amount: float,
+                            job_id: str | None = None):
     """
     Add a new booking document to the MongoDB 'bookings' collection.
+    With `job_id` the insert is idempotent: repeating it returns the existing booking.
 
     :param customer_name: Name of the customer
     :param phone: Customer phone number
@@ -272,6 +289,7 @@ async def add_booking_to_db(customer_name: str, phone: str, service: str, date:
     :param date: Booking date (YYYY-MM-DD)
     :param time: Booking time (HH:MM)
     :param amount: Service cost
+    :param job_id: Booking job that creates this booking, if any
     :return: The inserted document (with MongoDB _id)
     """
     booking_doc = {
@@ -285,6 +303,17 @@ async def add_booking_to_db(customer_name: str, phone: str, service: str, date:
         "created_at": datetime.now(timezone.utc)
     }
 
+    if job_id is not None:
+        booking_doc["job_id"] = job_id
+        stored = await bookings_collection.find_one_and_update(
+            {"job_id": job_id},
+            {"$setOnInsert": booking_doc},
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+        stored["_id"] = str(stored["_id"])
+        return stored
+
     result = await bookings_collection.insert_one(booking_doc)
     booking_doc["_id"] = str(result.inserted_id)
     return booking_doc
@@ -313,6 +342,7 @@ async def daraja_callback(request: Request):
     )
     if update_result.modified_count == 0:
         return {"ResultCode": 1, "ResultDesc": f"No payment found for {checkout_id}"}
+    PAYMENT_EVENTS.publish(checkout_id, new_status)
 
     return {"ResultCode": 0, "ResultDesc": "Accepted"}
 
@@ -1,7 +1,10 @@
 from fastapi import FastAPI, HTTPException, Request
-from .api.utils import check_service, calculate_payment, initiate_payment, poll_payment_status
-from .api.utils import router as daraja_router, generate_receipt, add_booking_to_db
-from .api.google_calendar import add_to_calendar
+from fastapi.responses import JSONResponse
+from .api.utils import check_service, calculate_payment, resolve_service_name
+from .api.utils import router as daraja_router, watch_payment_updates
+from .api.booking_jobs import BOOKING_JOBS, job_view
+from app.utils.pdf_generator import RECEIPT_RENDERER
+import asyncio
 from typing import Optional
 from pydantic import BaseModel
 
@@ -16,6 +19,47 @@ app = FastAPI()
 
 app.include_router(daraja_router, prefix="/daraja")
 
+_payment_watcher: Optional[asyncio.Task] = None
+_job_resumer: Optional[asyncio.Task] = None
+
+
+@app.on_event("startup")
+async def start_payment_watcher():
+    global _payment_watcher
+    _payment_watcher = asyncio.create_task(watch_payment_updates())
+
+
+async def _resume_jobs(delay: float = 5.0):
+    # Retried until MongoDB is reachable, without holding up startup
+    while True:
+        try:
+            resumed = await BOOKING_JOBS.resume()
+        except Exception as e:
+            print(f"Resuming booking jobs failed, retrying in {delay:.0f}s: {e}")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 300.0)
+            continue
+        if resumed:
+            print(f"Resumed {resumed} booking jobs")
+        return
+
+
+@app.on_event("startup")
+async def resume_booking_jobs():
+    # Jobs interrupted by a restart continue from their last completed step
+    global _job_resumer
+    _job_resumer = asyncio.create_task(_resume_jobs())
+
+
+@app.on_event("shutdown")
+async def stop_payment_watcher():
+    if _payment_watcher is not None:
+        _payment_watcher.cancel()
+    if _job_resumer is not None:
+        _job_resumer.cancel()
+    await BOOKING_JOBS.close()
+    await RECEIPT_RENDERER.close()
+
 
 @app.post("/bookings/full_flow")
 async def booking_full_flow(request: BookingRequest):
@@ -27,51 +71,47 @@ async def booking_full_flow(request: BookingRequest):
 
     status = {}
 
-    # 1️⃣ Check service exists
-    service_ok = await check_service(service_name)
-    if not service_ok:
-        status["service_check"] = "failed"
-        raise HTTPException(status_code=400, detail="Service not found")
+    # 1️⃣ Check service exists (tolerating wording like "gel mani")
+    if not await check_service(service_name):
+        resolved, candidates = await resolve_service_name(service_name)
+        if resolved is None:
+            status["service_check"] = "failed"
+            raise HTTPException(
+                status_code=400,
+                detail={
+                    "message": "Service not found",
+                    "did_you_mean": [c["name"] for c in candidates],
+                },
+            )
+        service_name = resolved
     status["service_check"] = "success"
+    status["service_name"] = service_name
 
     # 2️⃣ Calculate deposit
     amount = await calculate_payment(service_name)
     status["payment_amount"] = amount
 
-
-    payment = await initiate_payment(phone_number, amount)
-    if not payment["id"]:
-        raise HTTPException(status_code=400, detail="Payment initiation failed")
-
-    status = {"payment": "pending"}
-
-    # 2️⃣ Poll payment status until callback updates the DB
-    payment_status = await poll_payment_status(payment["id"])
-    if payment_status != "success":
-        status["payment"] = "failed"
-        raise HTTPException(status_code=400, detail="Payment failed or timed out")
-
-    status["payment"] = "success"
-
-   # 5️⃣ Generate receipt
-    receipt_path = await generate_receipt(payment["id"], customer_name, service_name)
-    status["receipt"] = "success"
-
-    # 6️⃣ Add booking to DB
-    booking = await add_booking_to_db(customer_name, phone_number, service_name, date, time, amount)
-    status["db"] = "success"
-
-     # 7️⃣ Add to Google Calendar
-    calendar_link = await add_to_calendar(customer_name, date, time, service_name)
-    status["calendar"] = "success"
-
-    # 8️⃣ Return results
-    return {
-        "message": "Booking complete",
-        "booking": booking,
-        "payment": payment,
-        "receipt_path": receipt_path,
-        "calendar_link": calendar_link,
-        "status": status,
-        "next_step": "Please provide feedback"
-    }
+    # 3️⃣ Payment, receipt, booking and calendar run as a persisted job, so
+    # the request doesn't stay open while the customer approves the payment
+    job = await BOOKING_JOBS.submit(customer_name, phone_number, service_name, date, time, amount)
+    return JSONResponse(
+        status_code=202,
+        content={
+            "message": "Booking started. Approve the M-Pesa prompt on your phone.",
+            "job_id": job["_id"],
+            "state": job["state"],
+            "status_url": f"/bookings/jobs/{job['_id']}",
+            "status": status,
+        },
+    )
+
+
+@app.get("/bookings/jobs/{job_id}")
+async def booking_job_status(job_id: str):
+    job = await BOOKING_JOBS.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Booking job not found")
+    view = job_view(job)
+    if view["state"] == "completed":
+        view["next_step"] = "Please provide feedback"
+    return view
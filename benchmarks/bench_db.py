@@ -0,0 +1,71 @@
+"""
+Compare SQLite throughput with SQLAlchemy defaults vs the tuned profile in
+app/database.py under a mixed concurrent read/write workload.
+
+    python -m benchmarks.bench_db [--threads 8] [--ops 200]
+"""
+import argparse
+import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, time as dtime
+
+from sqlalchemy import create_engine, func
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import sessionmaker
+
+from app.database import Base, make_engine
+from app.schemas import Booking
+
+
+def run(engine, threads: int, ops: int) -> dict:
+    Base.metadata.create_all(bind=engine)
+    Session = sessionmaker(bind=engine)
+    errors = 0
+
+    def worker(n: int):
+        nonlocal errors
+        for i in range(ops):
+            with Session() as db:
+                try:
+                    if i % 4 == 0:
+                        db.add(Booking(
+                            customer_name=f"Bench {n}", phone_number=f"07{n:08d}",
+                            service_name="Pedicure", date=date(2025, 1, 1 + i % 28),
+                            time=dtime(10, 0), amount=1500,
+                        ))
+                        db.commit()
+                    else:
+                        db.query(func.count(Booking.id)).filter(Booking.phone_number == f"07{n:08d}").scalar()
+                except OperationalError:
+                    errors += 1
+                    db.rollback()
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(threads) as pool:
+        list(pool.map(worker, range(threads)))
+    elapsed = time.perf_counter() - start
+    engine.dispose()
+    return {"ops_per_sec": threads * ops / elapsed, "seconds": elapsed, "errors": errors}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--ops", type=int, default=200)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        baseline_url = f"sqlite:///{os.path.join(tmp, 'baseline.db')}"
+        tuned_url = f"sqlite:///{os.path.join(tmp, 'tuned.db')}"
+        baseline = run(create_engine(baseline_url, connect_args={"check_same_thread": False}), args.threads, args.ops)
+        tuned = run(make_engine(tuned_url), args.threads, args.ops)
+
+    for name, result in (("defaults", baseline), ("tuned", tuned)):
+        print(f"{name:>9}: {result['ops_per_sec']:8.0f} ops/s  {result['seconds']:6.2f}s  errors={result['errors']}")
+    print(f"  speedup: {tuned['ops_per_sec'] / baseline['ops_per_sec']:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
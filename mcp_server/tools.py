@@ -1,35 +1,70 @@
 
+import os
 import httpx
-from mcp.types import CallToolResult, TextContent
+from mcp.types import CallToolResult, TextContent, ToolAnnotations
 from mcp.server.fastmcp import FastMCP
 
 mcp = FastMCP()
-API_BASE_URL = "http://localhost:9000/api"
+API_BASE_URL = os.getenv("API_BASE_URL", "http://localhost:9000/api")
+
+# Transport used by every tool's HTTP client. None means real network I/O;
+# use_asgi_app() swaps in an in-memory transport when the tools run inside
+# the API process.
+_transport: httpx.AsyncBaseTransport | None = None
+
+
+def use_asgi_app(app) -> None:
+    """Route tool HTTP calls straight into the given ASGI app (no sockets)."""
+    global _transport
+    _transport = httpx.ASGITransport(app=app)
+
+
+def _client() -> httpx.AsyncClient:
+    return httpx.AsyncClient(transport=_transport)
+
+
+# Tools marked read-only may be run concurrently by the bot; everything else
+# (bookings, payments, feedback) is treated as having side effects and is
+# executed one at a time, in the order the model requested.
+READ_ONLY = ToolAnnotations(readOnlyHint=True)
+SIDE_EFFECTS = ToolAnnotations(readOnlyHint=False)
 
 
 # -----------------------------------------------------
 # 1️⃣ Services
 # -----------------------------------------------------
-@mcp.tool("get_services")
+@mcp.tool("get_services", annotations=READ_ONLY)
 async def get_services() -> CallToolResult:
     """Fetch all available services."""
-    async with httpx.AsyncClient() as client:
+    async with _client() as client:
         res = await client.get(f"{API_BASE_URL}/services/list")
     return CallToolResult(content=[TextContent(type="text", text=res.text)], isError=False)
 
 
-@mcp.tool("get_business_info")
+@mcp.tool("get_business_info", annotations=READ_ONLY)
 async def get_business_info() -> CallToolResult:
     """Fetch general business information (e.g., hours, address)."""
-    async with httpx.AsyncClient() as client:
+    async with _client() as client:
         res = await client.get(f"{API_BASE_URL}/services/")
     return CallToolResult(content=[TextContent(type="text", text=res.text)], isError=False)
 
 
+@mcp.tool("resolve_service", annotations=READ_ONLY)
+async def resolve_service(query: str) -> CallToolResult:
+    """
+    Match a customer's wording of a service (e.g. "gel mani", "knotless braid")
+    to catalog services. Returns ranked candidates with name, price, duration
+    and a 0-1 score; use the top name when booking.
+    """
+    async with _client() as client:
+        res = await client.get(f"{API_BASE_URL}/services/resolve", params={"q": query})
+    return CallToolResult(content=[TextContent(type="text", text=res.text)], isError=False)
+
+
 # -----------------------------------------------------
 # 2️⃣ Booking + Payment Orchestration
 # -----------------------------------------------------
-@mcp.tool("complete_booking_flow")
+@mcp.tool("complete_booking_flow", annotations=SIDE_EFFECTS)
 async def complete_booking_flow(
     customer_name: str,
     phone_number: str,
@@ -38,7 +73,8 @@ async def complete_booking_flow(
     time: str
 ) -> CallToolResult:
     """
-    Perform the full booking flow:
+    Start the full booking flow and return immediately (HTTP 202) with a job_id.
+    The flow runs in the background:
     - Verify service
     - Calculate 30% deposit
     - Initiate payment
@@ -46,8 +82,9 @@ async def complete_booking_flow(
     - Generate receipt
     - Save booking
     - Add to Google Calendar
+    Check progress with get_booking_job_status(job_id).
     """
-    async with httpx.AsyncClient() as client:
+    async with _client() as client:
         payload = {
             "customer_name": customer_name,
             "phone_number": phone_number,
@@ -60,27 +97,36 @@ async def complete_booking_flow(
     return CallToolResult(content=[TextContent(type="text", text=res.text)], isError=False)
 
 
+@mcp.tool("get_booking_job_status", annotations=READ_ONLY)
+async def get_booking_job_status(job_id: str) -> CallToolResult:
+    """
+    Get the progress of a booking started with complete_booking_flow.
+    `state` moves through created, payment_requested, paid, receipt_generated,
+    booked and ends at completed or failed (see `error`).
+    """
+    async with _client() as client:
+        res = await client.get(f"{API_BASE_URL}/bookings/jobs/{job_id}")
+    return CallToolResult(content=[TextContent(type="text", text=res.text)], isError=False)
+
+
 # -----------------------------------------------------
 # 3️⃣ User Utilities
 # -----------------------------------------------------
-@mcp.tool("get_user_bookings")
-async def get_user_bookings(phone_number: str) -> CallToolResult:
-    """Fetch all bookings made by a given phone number."""
-    async with httpx.AsyncClient() as client:
-        res = await client.get(f"{API_BASE_URL}/bookings/list")
-        data = res.json() if res.headers.get("content-type", "").startswith("application/json") else None
-
-        if isinstance(data, list):
-            filtered = [b for b in data if b.get("phone_number") == phone_number]
-            return CallToolResult(content=[TextContent(type="text", text=str(filtered))], isError=False)
-
+@mcp.tool("get_user_bookings", annotations=READ_ONLY)
+async def get_user_bookings(phone_number: str, limit: int = 20) -> CallToolResult:
+    """Fetch the most recent bookings made by a given phone number."""
+    async with _client() as client:
+        res = await client.get(
+            f"{API_BASE_URL}/bookings/list",
+            params={"phone_number": phone_number, "limit": limit},
+        )
     return CallToolResult(content=[TextContent(type="text", text=res.text)], isError=False)
 
 
-@mcp.tool("submit_feedback")
+@mcp.tool("submit_feedback", annotations=SIDE_EFFECTS)
 async def submit_feedback(name: str, rating: int, comments: str) -> CallToolResult:
     """Submit user feedback."""
-    async with httpx.AsyncClient() as client:
+    async with _client() as client:
         payload = {"name": name, "rating": rating, "comments": comments}
         res = await client.post(f"{API_BASE_URL}/feedback/", json=payload)
     return CallToolResult(content=[TextContent(type="text", text=res.text)], isError=False)
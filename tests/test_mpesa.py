@@ -0,0 +1,163 @@
+import asyncio
+import json
+
+import httpx
+import pytest
+
+from app.utils.mpesa import DarajaClient
+
+
+class FakeDaraja:
+    """In-process stand-in for the Daraja OAuth and STK push endpoints."""
+
+    def __init__(self, expires_in="3599", token_delay=0.05):
+        self.expires_in = expires_in
+        self.token_delay = token_delay
+        self.token_calls = 0
+        self.push_tokens: list[str] = []
+        self.revoked: set[str] = set()
+
+    async def handler(self, request: httpx.Request) -> httpx.Response:
+        if request.url.path == "/oauth/v1/generate":
+            assert request.headers["Authorization"].startswith("Basic ")
+            self.token_calls += 1
+            # Slow enough that concurrent callers overlap with the refresh
+            await asyncio.sleep(self.token_delay)
+            body = {"access_token": f"token-{self.token_calls}"}
+            if self.expires_in is not None:
+                body["expires_in"] = self.expires_in
+            return httpx.Response(200, json=body)
+        if request.url.path == "/mpesa/stkpush/v1/processrequest":
+            token = request.headers["Authorization"].removeprefix("Bearer ")
+            self.push_tokens.append(token)
+            if token in self.revoked:
+                return httpx.Response(401, json={"errorMessage": "Invalid Access Token"})
+            payload = json.loads(request.content)
+            return httpx.Response(200, json={
+                "CheckoutRequestID": f"ws_CO_{len(self.push_tokens)}",
+                "ResponseCode": "0",
+                "AccountReference": payload["AccountReference"],
+            })
+        return httpx.Response(404)
+
+    def client(self, **kwargs) -> DarajaClient:
+        return DarajaClient(
+            "https://daraja.test", "key", "secret",
+            transport=httpx.MockTransport(self.handler), **kwargs,
+        )
+
+
+class FakeClock:
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock():
+    # Injected into the client only; the event loop keeps the real clock
+    return FakeClock()
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def test_concurrent_callers_share_one_token_request():
+    daraja = FakeDaraja()
+
+    async def scenario():
+        client = daraja.client()
+        try:
+            return await asyncio.gather(*(client.get_access_token() for _ in range(20)))
+        finally:
+            await client.close()
+
+    tokens = run(scenario())
+    assert daraja.token_calls == 1
+    assert set(tokens) == {"token-1"}
+
+
+def test_concurrent_stk_pushes_fetch_one_token():
+    daraja = FakeDaraja()
+
+    async def scenario():
+        client = daraja.client()
+        try:
+            return await asyncio.gather(*(
+                client.stk_push({"AccountReference": f"Booking-{i}"}) for i in range(10)
+            ))
+        finally:
+            await client.close()
+
+    responses = run(scenario())
+    assert [r.status_code for r in responses] == [200] * 10
+    assert daraja.token_calls == 1
+    assert set(daraja.push_tokens) == {"token-1"}
+
+
+def test_token_reused_until_expires_in_minus_margin(clock):
+    daraja = FakeDaraja(expires_in="3599", token_delay=0)
+
+    async def scenario():
+        client = daraja.client(expiry_margin=60, clock=clock)
+        try:
+            first = await client.get_access_token()
+            clock.now += 3538
+            still_cached = await client.get_access_token()
+            clock.now += 1
+            refreshed = await client.get_access_token()
+            return first, still_cached, refreshed
+        finally:
+            await client.close()
+
+    assert run(scenario()) == ("token-1", "token-1", "token-2")
+    assert daraja.token_calls == 2
+
+
+def test_short_expires_in_is_never_cached_past_it(clock):
+    # Shorter than the safety margin: refresh on every call rather than reuse a dying token
+    daraja = FakeDaraja(expires_in="30", token_delay=0)
+
+    async def scenario():
+        client = daraja.client(expiry_margin=60, clock=clock)
+        try:
+            return [await client.get_access_token() for _ in range(3)]
+        finally:
+            await client.close()
+
+    assert run(scenario()) == ["token-1", "token-2", "token-3"]
+
+
+def test_missing_expires_in_defaults_to_an_hour(clock):
+    daraja = FakeDaraja(expires_in=None, token_delay=0)
+
+    async def scenario():
+        client = daraja.client(expiry_margin=60, clock=clock)
+        try:
+            await client.get_access_token()
+            clock.now += 3500
+            return await client.get_access_token()
+        finally:
+            await client.close()
+
+    assert run(scenario()) == "token-1"
+    assert daraja.token_calls == 1
+
+
+def test_rejected_token_is_refreshed_once():
+    daraja = FakeDaraja(token_delay=0)
+    daraja.revoked.add("token-1")
+
+    async def scenario():
+        client = daraja.client()
+        try:
+            return await client.stk_push({"AccountReference": "Booking-1"})
+        finally:
+            await client.close()
+
+    response = run(scenario())
+    assert response.status_code == 200
+    assert daraja.push_tokens == ["token-1", "token-2"]
@@ -0,0 +1,68 @@
+import asyncio
+import time
+from urllib.parse import parse_qs
+
+import httpx
+
+from whatsapp.client import TwilioSender
+
+
+class FakeTwilio:
+    """In-process stand-in for Twilio's Messages endpoint."""
+
+    def __init__(self):
+        self.sent: list[tuple[str, str, float]] = []
+
+    async def handler(self, request: httpx.Request) -> httpx.Response:
+        form = {k: v[0] for k, v in parse_qs(request.content.decode()).items()}
+        self.sent.append((form["To"], form["Body"], time.monotonic()))
+        return httpx.Response(201, json={"sid": f"SM{len(self.sent)}"})
+
+    def sender(self, **kwargs) -> TwilioSender:
+        return TwilioSender(
+            "AC123", "token", "whatsapp:+14155238886",
+            transport=httpx.MockTransport(self.handler), **kwargs,
+        )
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def test_hot_recipient_does_not_delay_others():
+    twilio = FakeTwilio()
+
+    async def scenario():
+        # 600/min per number: one message every 0.1 s to the same recipient
+        sender = twilio.sender(concurrency=4, per_number_per_minute=600, account_per_minute=0)
+        try:
+            start = time.monotonic()
+            burst = [asyncio.create_task(sender.send("+254A", f"a{i}")) for i in range(8)]
+            await asyncio.sleep(0)
+            await sender.send("+254B", "b")
+            other_done = time.monotonic() - start
+            await asyncio.gather(*burst)
+            return other_done, time.monotonic() - start
+        finally:
+            await sender.close()
+
+    other_done, burst_done = run(scenario())
+    assert other_done < 0.1
+    assert burst_done >= 0.65  # the hot number is still rate limited
+    assert [body for to, body, _ in twilio.sent if to == "whatsapp:+254A"] == [f"a{i}" for i in range(8)]
+
+
+def test_close_cancels_unsent_messages():
+    twilio = FakeTwilio()
+
+    async def scenario():
+        sender = twilio.sender(per_number_per_minute=1, account_per_minute=0)
+        first = asyncio.create_task(sender.send("+254A", "now"))
+        later = asyncio.create_task(sender.send("+254A", "in a minute"))
+        await first
+        await sender.close(drain_timeout=0.1)
+        return later
+
+    later = run(scenario())
+    assert later.cancelled()
+    assert [body for _, body, _ in twilio.sent] == ["now"]
@@ -2,10 +2,15 @@ import os
 import json
 import asyncio
 from openai import AsyncOpenAI
-from mcp import ClientSession
-from mcp.client.stdio import stdio_client, StdioServerParameters
+from mcp.client.stdio import StdioServerParameters
 from dotenv import load_dotenv
-from .memory import init_memory_db, load_memory, save_memory
+from .memory import init_memory_db, load_memory, save_memory, MEMORY_STORE
+from .mcp_pool import MCPSessionPool
+from .tool_dispatch import inprocess_session
+from .governor import OpenAIGovernor
+from .locks import KeyedLock
+from .prompt import system_prompt
+from .compaction import compact, fit_to_budget, for_prompt, make_message, total_tokens
 
 # initialize once
 init_memory_db()
@@ -13,11 +18,57 @@ init_memory_db()
 load_dotenv()
 
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
-client = AsyncOpenAI(api_key=OPENAI_API_KEY)
+# Retries are handled by the governor, which honours retry-after hints
+client = AsyncOpenAI(api_key=OPENAI_API_KEY, max_retries=0)
+
+# Admission control shared by every completion call in this process
+OPENAI_GOVERNOR = OpenAIGovernor(
+    client,
+    max_concurrency=int(os.getenv("OPENAI_MAX_CONCURRENCY", "8")),
+    max_queue=int(os.getenv("OPENAI_MAX_QUEUE", "100")),
+    requests_per_minute=float(os.getenv("OPENAI_RPM_LIMIT", "500")),
+    tokens_per_minute=float(os.getenv("OPENAI_TPM_LIMIT", "200000")),
+    deadline=float(os.getenv("OPENAI_CALL_DEADLINE", "60")),
+    max_retries=int(os.getenv("OPENAI_MAX_RETRIES", "3")),
+)
 
 # In-memory per-user chat memory (simple, process-local)
 CONVERSATIONS = {}
-CONV_LOCK = asyncio.Lock()
+# Serializes each user's turns end to end (load -> LLM/tools -> save);
+# different users run fully in parallel
+USER_LOCKS = KeyedLock()
+
+# Token budget for stored history sent with each prompt; older turns are
+# folded into a rolling summary once a conversation grows past it
+HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", "1500"))
+SUMMARY_MAX_TOKENS = int(os.getenv("SUMMARY_MAX_TOKENS", "300"))
+
+# Static instructions; kept first and unchanged so the prompt prefix is cacheable
+SYSTEM_INSTRUCTIONS = (
+    "You are a helpful assistant for Glow Haven Beauty Lounge."
+    "All the prices are in kenya shillings."
+    "Help customers with bookings, questions about services, and general inquiries. "
+    "Be friendly and professional. Do not answer questions outside the business. "
+    "Customers can book services and pay a 30% deposit via M-Pesa. "
+    "Always calculate the deposit as 30% of the total service price before initiating payment. "
+    "When a user wants to make a booking: collect any missing details (customer name, service name, date, time, total amount). "
+    "Then CALL THE TOOLS to execute the flow in this exact order: "
+    "1) create_booking(customer_name, phone_number, service_name, date, time, amount), using the phone number in context unless the user provides a different one. "
+    "2) Compute deposit = 30% of amount and confirm to the user that an STK push will be sent. "
+    "3) Use the created booking's details. If response parsing fails, call find_booking(customer_name, service_name) to get booking_id and phone_number. "
+    "4) initiate_payment(phone_number, deposit, booking_id). "
+    "5) poll_payment_status(booking_id, timeout_seconds=30) and report success/failure to the user. "
+    "complete_booking_flow returns a job_id while the booking continues in the background: tell the user to approve "
+    "the M-Pesa prompt, and use get_booking_job_status(job_id) when they ask about progress. "
+    "Prices, durations and opening hours are listed in the business catalog below; answer from it directly "
+    "and only call get_services or get_business_info for details it does not contain. "
+    "Do not just explain steps—actually call the tools. Be concise and actionable in replies."
+)
+
+# Strong references to fire-and-forget tasks so they are not garbage collected
+BACKGROUND_TASKS: set[asyncio.Task] = set()
+# Users whose history is being summarized right now
+COMPACTING: set[str] = set()
 
 # Shared MCP server parameters
 MCP_SERVER_PARAMS = StdioServerParameters(
@@ -26,9 +77,34 @@ MCP_SERVER_PARAMS = StdioServerParameters(
     env=None,
 )
 
+# Long-lived pool of initialized MCP sessions shared by all conversations
+MCP_POOL_SIZE = int(os.getenv("MCP_POOL_SIZE", "2"))
+MCP_HEALTHCHECK_INTERVAL = float(os.getenv("MCP_HEALTHCHECK_INTERVAL", "30"))
+MCP_POOL = MCPSessionPool(
+    MCP_SERVER_PARAMS,
+    size=MCP_POOL_SIZE,
+    healthcheck_interval=MCP_HEALTHCHECK_INTERVAL,
+)
+
+# "mcp" calls tools over stdio through MCP_POOL; "inprocess" calls the same
+# tool functions directly in this process (single-host deployments)
+TOOL_DISPATCH_MODE = os.getenv("TOOL_DISPATCH_MODE", "mcp").lower()
+
+
+def tool_session():
+    """Return an async context manager yielding a session with list_tools/call_tool."""
+    if TOOL_DISPATCH_MODE == "inprocess":
+        return inprocess_session()
+    return MCP_POOL.session()
+
+# Max number of read-only tool calls from one assistant turn run at once
+TOOL_CALL_CONCURRENCY = int(os.getenv("TOOL_CALL_CONCURRENCY", "4"))
+
 # Cached tools and lock for concurrency-safe one-time init
 TOOLS_CACHE = None
 TOOLS_LOCK = asyncio.Lock()
+# Names of tools annotated readOnlyHint=True; all others are serialized
+READ_ONLY_TOOLS: set[str] = set()
 
 async def load_tools_once():
     global TOOLS_CACHE
@@ -37,11 +113,8 @@ async def load_tools_once():
     async with TOOLS_LOCK:
         if TOOLS_CACHE is not None:
             return TOOLS_CACHE
-        # Open a short-lived session just to list tools once
-        async with stdio_client(MCP_SERVER_PARAMS) as (read_stream, write_stream):
-            async with ClientSession(read_stream, write_stream) as session:
-                await session.initialize()
-                tools_result = await session.list_tools()
+        async with tool_session() as session:
+            tools_result = await session.list_tools()
         tools = [
             {
                 "type": "function",
@@ -53,48 +126,71 @@ async def load_tools_once():
             }
             for tool in tools_result.tools
         ]
+        READ_ONLY_TOOLS.update(
+            tool.name
+            for tool in tools_result.tools
+            if tool.annotations is not None and tool.annotations.readOnlyHint
+        )
         TOOLS_CACHE = tools
         return tools
 
+
+async def run_tool_calls(session, tool_calls) -> list[str]:
+    """
+    Execute the tool calls of one assistant turn and return their text results
+    in the same order as `tool_calls`.
+    Consecutive read-only calls run concurrently (up to TOOL_CALL_CONCURRENCY);
+    a call with side effects waits for everything before it and runs alone.
+    """
+    semaphore = asyncio.Semaphore(max(1, TOOL_CALL_CONCURRENCY))
+
+    async def call(tool_call) -> str:
+        tool_args = json.loads(tool_call.function.arguments)
+        async with semaphore:
+            result = await session.call_tool(tool_call.function.name, arguments=tool_args)
+        return result.content[0].text
+
+    results: list[str] = []
+    batch = []
+    for tool_call in tool_calls:
+        if tool_call.function.name in READ_ONLY_TOOLS:
+            batch.append(tool_call)
+            continue
+        if batch:
+            results.extend(await asyncio.gather(*(call(tc) for tc in batch)))
+            batch = []
+        results.append(await call(tool_call))
+    if batch:
+        results.extend(await asyncio.gather(*(call(tc) for tc in batch)))
+    return results
+
 async def chat_with_bot(user_message: str, user_id: str | None = None) -> str:
     """
     Send a message to OpenAI with MCP tools available.
-    If user_id is provided, maintain short-term chat memory per user.
+    If user_id is provided, maintain short-term chat memory per user and
+    process that user's messages strictly one at a time.
     """
+    if not user_id:
+        return await _chat_turn(user_message, None)
+    async with USER_LOCKS.hold(user_id):
+        return await _chat_turn(user_message, user_id)
+
 
+async def _chat_turn(user_message: str, user_id: str | None) -> str:
     # Ensure tools are loaded once and cached
     tools = await load_tools_once()
 
     # Build conversation with optional memory
-    async with CONV_LOCK:
-        history = load_memory(user_id) if user_id else []
-        messages = [
-            {
-                "role": "system",
-                "content": (
-                    "You are a helpful assistant for Glow Haven Beauty Lounge."
-                    "All the prices are in kenya shillings."
-                    "Help customers with bookings, questions about services, and general inquiries. "
-                    "Be friendly and professional. Do not answer questions outside the business. "
-                    "Customers can book services and pay a 30% deposit via M-Pesa. "
-                    "Always calculate the deposit as 30% of the total service price before initiating payment. "
-                    "When a user wants to make a booking: collect any missing details (customer name, service name, date, time, total amount). "
-                    "Then CALL THE TOOLS to execute the flow in this exact order: "
-                    "1) create_booking(customer_name, phone_number, service_name, date, time, amount), using the phone number in context unless the user provides a different one. "
-                    "2) Compute deposit = 30% of amount and confirm to the user that an STK push will be sent. "
-                    "3) Use the created booking's details. If response parsing fails, call find_booking(customer_name, service_name) to get booking_id and phone_number. "
-                    "4) initiate_payment(phone_number, deposit, booking_id). "
-                    "5) poll_payment_status(booking_id, timeout_seconds=30) and report success/failure to the user. "
-                    "Do not just explain steps—actually call the tools. Be concise and actionable in replies."
-                )
-            }
-        ] + history + [{"role": "user", "content": user_message}]
+    history = await load_memory(user_id) if user_id else []
+    messages = [
+        {"role": "system", "content": system_prompt(SYSTEM_INSTRUCTIONS)}
+    ] + for_prompt(fit_to_budget(history, HISTORY_TOKEN_BUDGET))
 
     # Current user turn
     messages.append({"role": "user", "content": user_message})
 
     # First call to OpenAI
-    response = await client.chat.completions.create(
+    response = await OPENAI_GOVERNOR.chat_completion(
         model="gpt-4o-mini",
         messages=messages,
         tools=tools,
@@ -103,7 +199,7 @@ async def chat_with_bot(user_message: str, user_id: str | None = None) -> str:
 
     assistant_message = response.choices[0].message
 
-    # If tools are requested, call them via a short-lived MCP session
+    # If tools are requested, call them via a pooled MCP session (or in-process)
     if assistant_message.tool_calls:
         messages.append({
             "role": "assistant",
@@ -121,23 +217,18 @@ async def chat_with_bot(user_message: str, user_id: str | None = None) -> str:
             ],
         })
 
-        async with stdio_client(MCP_SERVER_PARAMS) as (read_stream, write_stream):
-            async with ClientSession(read_stream, write_stream) as session:
-                await session.initialize()
-                for tool_call in assistant_message.tool_calls:
-                    tool_name = tool_call.function.name
-                    tool_args = json.loads(tool_call.function.arguments)
-
-                    result = await session.call_tool(tool_name, arguments=tool_args)
+        async with tool_session() as session:
+            results = await run_tool_calls(session, assistant_message.tool_calls)
 
-                    messages.append({
-                        "role": "tool",
-                        "tool_call_id": tool_call.id,
-                        "content": result.content[0].text,
-                    })
+        for tool_call, content in zip(assistant_message.tool_calls, results):
+            messages.append({
+                "role": "tool",
+                "tool_call_id": tool_call.id,
+                "content": content,
+            })
 
         # Second call to OpenAI with tool results
-        final_response = await client.chat.completions.create(
+        final_response = await OPENAI_GOVERNOR.chat_completion(
             model="gpt-4o-mini",
             messages=messages,
         )
@@ -146,18 +237,62 @@ async def chat_with_bot(user_message: str, user_id: str | None = None) -> str:
         # Direct response without tools
         final_text = assistant_message.content
 
-    # Update memory with the latest user/assistant turns (cap size)
-
+    # Update memory with the latest user/assistant turns
     if user_id:
         convo = history + [
-            {"role": "user", "content": user_message},
-            {"role": "assistant", "content": final_text},
+            make_message("user", user_message),
+            make_message("assistant", final_text),
         ]
-        save_memory(user_id, convo)
+        await save_memory(user_id, convo)
+        if total_tokens(convo) > HISTORY_TOKEN_BUDGET:
+            # Summarize after replying so the user doesn't wait for it
+            task = asyncio.create_task(_compact_memory(user_id))
+            BACKGROUND_TASKS.add(task)
+            task.add_done_callback(BACKGROUND_TASKS.discard)
 
+    return final_text
 
 
-    return final_text
+async def _summarize(messages: list[dict]) -> str:
+    transcript = "\n".join(f"{m['role']}: {m['content']}" for m in messages)
+    response = await OPENAI_GOVERNOR.chat_completion(
+        model="gpt-4o-mini",
+        messages=[
+            {
+                "role": "system",
+                "content": (
+                    "Summarize this conversation between a salon customer and the Glow Haven assistant. "
+                    "Keep every concrete detail: customer name, phone number, services, dates, times, prices, "
+                    "booking IDs and payment status. Be brief."
+                ),
+            },
+            {"role": "user", "content": transcript},
+        ],
+        max_tokens=SUMMARY_MAX_TOKENS,
+    )
+    return response.choices[0].message.content
+
+
+async def _compact_memory(user_id: str):
+    """Fold older turns of an over-budget conversation into its rolling summary."""
+    if user_id in COMPACTING:
+        return  # the running compaction will cover this turn's overflow too
+    COMPACTING.add(user_id)
+    try:
+        # Summarize a snapshot without the user's lock, so their next
+        # message isn't stuck behind the summary completion
+        snapshot = await load_memory(user_id)
+        compacted = await compact(snapshot, HISTORY_TOKEN_BUDGET, _summarize)
+        if compacted is snapshot:
+            return
+        async with USER_LOCKS.hold(user_id):
+            current = await load_memory(user_id)
+            if current[:len(snapshot)] != snapshot:
+                return  # rewritten meanwhile; the next over-budget turn compacts again
+            # Keep the turns that arrived while the summary was being written
+            await save_memory(user_id, compacted + current[len(snapshot):])
+    finally:
+        COMPACTING.discard(user_id)
 
 async def main():
     print("=" * 60)
@@ -184,5 +319,8 @@ async def main():
             print(f"\n❌ Error: {str(e)}\n")
             print("Please try again or type 'quit' to exit.\n")
 
+    await MCP_POOL.close()
+    await MEMORY_STORE.close()
+
 if __name__ == "__main__":
     asyncio.run(main())
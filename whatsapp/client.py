@@ -1,10 +1,14 @@
 
 # whatsapp/client.py
 import os
+import random
 from dotenv import load_dotenv
 from twilio.rest import Client
 import asyncio
+import httpx
+from collections import deque
 from typing import Optional
+from whatsapp.governor import TokenBucket
 
 load_dotenv()
 
@@ -37,12 +41,186 @@ def send_whatsapp_message_sync(to: str, body: str) -> str:
     return msg.sid
 
 
-async def send_whatsapp_message(to: str, body: str) -> str:
+class TwilioSender:
     """
-    Async wrapper around the synchronous Twilio send function.
-    Safe to call from async code.
+    Async WhatsApp sender talking to Twilio's REST API over one shared
+    keep-alive HTTP client.
+    - Each recipient with pending messages has its own FIFO, drained by one
+      task; a recipient waiting on its rate limit never holds up the others
+    - At most `concurrency` requests are in flight and `max_queue` sends wait
+    - Token buckets limit messages per recipient and per account
+    - Messages to the same recipient are delivered in the order queued
+    - 429 and 5xx responses are retried with backoff, honouring Retry-After
+    Point `base_url` at a local fake (or pass an httpx `transport`) for tests.
     """
-    loop = asyncio.get_running_loop()
-    sid = await loop.run_in_executor(None, send_whatsapp_message_sync, to, body)
-    return sid
 
+    def __init__(
+        self,
+        account_sid: str | None,
+        auth_token: str | None,
+        from_number: str,
+        base_url: str = "https://api.twilio.com",
+        concurrency: int = 4,
+        max_queue: int = 1000,
+        per_number_per_minute: float = 60,
+        account_per_minute: float = 600,
+        max_retries: int = 3,
+        transport: httpx.AsyncBaseTransport | None = None,
+    ):
+        self.account_sid = account_sid
+        self.auth_token = auth_token
+        self.from_number = from_number
+        self.base_url = base_url
+        self.concurrency = max(1, concurrency)
+        self.max_queue = max_queue
+        self.per_number_per_minute = per_number_per_minute
+        self.max_retries = max_retries
+        self._transport = transport
+        self._account_bucket = TokenBucket(account_per_minute)
+        self._number_buckets: dict[str, TokenBucket] = {}
+        self._http: httpx.AsyncClient | None = None
+        self._lanes: dict[str, deque] = {}
+        self._lane_tasks: dict[str, asyncio.Task] = {}
+        self._slots: asyncio.Semaphore | None = None
+        self._in_flight: asyncio.Semaphore | None = None
+
+        # Metrics
+        self.sent = 0
+        self.retries = 0
+        self.failed = 0
+
+    def _start(self):
+        if self._http is not None:
+            return
+        if not self.account_sid or not self.auth_token:
+            raise RuntimeError("Twilio credentials are not set in environment variables.")
+        self._http = httpx.AsyncClient(
+            base_url=self.base_url,
+            auth=(self.account_sid, self.auth_token),
+            timeout=httpx.Timeout(15.0),
+            limits=httpx.Limits(max_connections=self.concurrency, max_keepalive_connections=self.concurrency),
+            transport=self._transport,
+        )
+        self._slots = asyncio.Semaphore(self.max_queue)
+        self._in_flight = asyncio.Semaphore(self.concurrency)
+
+    async def send(self, to: str, body: str, media_url: str | None = None) -> str:
+        """Queue a WhatsApp message and wait until Twilio accepts it; returns the message SID."""
+        self._start()
+        if not to.startswith("whatsapp:"):
+            to = f"whatsapp:{to}"
+        form = {"From": self.from_number, "To": to, "Body": body}
+        if media_url:
+            form["MediaUrl"] = media_url
+        future = asyncio.get_running_loop().create_future()
+        # Blocks (backpressure) when max_queue sends are already waiting
+        await self._slots.acquire()
+        lane = self._lanes.get(to)
+        if lane is None:
+            lane = self._lanes[to] = deque()
+            self._lane_tasks[to] = asyncio.create_task(self._drain(to, lane))
+        lane.append((form, future))
+        return await future
+
+    def _bucket_for(self, to: str) -> TokenBucket:
+        bucket = self._number_buckets.get(to)
+        if bucket is None:
+            if len(self._number_buckets) > 10_000:
+                self._number_buckets.clear()
+            bucket = self._number_buckets[to] = TokenBucket(self.per_number_per_minute, capacity=1)
+        return bucket
+
+    async def _drain(self, to: str, lane: deque):
+        """Send one recipient's messages in order; ends when its FIFO is empty."""
+        try:
+            while lane:
+                form, future = lane[0]
+                try:
+                    sid = await self._post(to, form)
+                    if not future.done():
+                        future.set_result(sid)
+                except Exception as e:
+                    self.failed += 1
+                    if not future.done():
+                        future.set_exception(e)
+                finally:
+                    if not future.done():  # cancelled mid-send
+                        future.cancel()
+                    lane.popleft()
+                    self._slots.release()
+        finally:
+            # Only left early when cancelled by close()
+            for _, future in lane:
+                future.cancel()
+                self._slots.release()
+            lane.clear()
+            del self._lanes[to]
+            del self._lane_tasks[to]
+
+    async def _post(self, to: str, form: dict) -> str:
+        url = f"/2010-04-01/Accounts/{self.account_sid}/Messages.json"
+        attempt = 0
+        while True:
+            await self._bucket_for(to).acquire()
+            await self._account_bucket.acquire()
+            try:
+                async with self._in_flight:
+                    response = await self._http.post(url, data=form)
+            except httpx.TransportError:
+                if attempt >= self.max_retries:
+                    raise
+                retry_after = None
+            else:
+                if response.status_code < 400:
+                    self.sent += 1
+                    return response.json()["sid"]
+                retryable = response.status_code == 429 or response.status_code >= 500
+                if not retryable or attempt >= self.max_retries:
+                    raise RuntimeError(f"Twilio send failed ({response.status_code}): {response.text}")
+                retry_after = response.headers.get("Retry-After")
+            attempt += 1
+            self.retries += 1
+            delay = float(retry_after) if retry_after and retry_after.isdigit() else random.uniform(0, 2 ** attempt)
+            await asyncio.sleep(delay)
+
+    def snapshot(self) -> dict:
+        return {
+            "queued": sum(len(lane) for lane in self._lanes.values()),
+            "active_recipients": len(self._lanes),
+            "sent": self.sent,
+            "retries": self.retries,
+            "failed": self.failed,
+        }
+
+    async def close(self, drain_timeout: float = 10.0):
+        """Let queued messages go out (cancelling what is left after `drain_timeout`), then close the HTTP client."""
+        if self._http is None:
+            return
+        tasks = list(self._lane_tasks.values())
+        if tasks:
+            _, pending = await asyncio.wait(tasks, timeout=drain_timeout)
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+        await self._http.aclose()
+        self._http = None
+
+
+TWILIO_SENDER = TwilioSender(
+    TWILIO_ACCOUNT_SID,
+    TWILIO_AUTH_TOKEN,
+    TWILIO_WHATSAPP_NUMBER,
+    base_url=os.getenv("TWILIO_API_BASE_URL", "https://api.twilio.com"),
+    concurrency=int(os.getenv("TWILIO_SEND_CONCURRENCY", "4")),
+    max_queue=int(os.getenv("TWILIO_SEND_QUEUE", "1000")),
+    per_number_per_minute=float(os.getenv("TWILIO_PER_NUMBER_PER_MINUTE", "60")),
+    account_per_minute=float(os.getenv("TWILIO_ACCOUNT_PER_MINUTE", "600")),
+)
+
+
+async def send_whatsapp_message(to: str, body: str, media_url: str | None = None) -> str:
+    """
+    Send a WhatsApp message through the shared async Twilio sender.
+    Safe to call from async code; returns the message SID.
+    """
+    return await TWILIO_SENDER.send(to, body, media_url=media_url)
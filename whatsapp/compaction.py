@@ -0,0 +1,93 @@
+# whatsapp/compaction.py
+import logging
+from typing import Awaitable, Callable
+
+try:
+    import tiktoken
+    _ENCODING = tiktoken.get_encoding("o200k_base")
+except Exception:  # tiktoken is optional; fall back to an estimate
+    _ENCODING = None
+
+logger = logging.getLogger("chat_compaction")
+
+SUMMARY_PREFIX = "Summary of the earlier conversation: "
+
+Summarizer = Callable[[list[dict]], Awaitable[str]]
+
+
+def count_tokens(text: str | None) -> int:
+    if not text:
+        return 0
+    if _ENCODING is not None:
+        return len(_ENCODING.encode(text))
+    return len(text) // 4 + 1
+
+
+def make_message(role: str, content: str | None, **extra) -> dict:
+    """A stored history message, annotated with its token count."""
+    return {"role": role, "content": content, "tokens": count_tokens(content) + 4, **extra}
+
+
+def message_tokens(message: dict) -> int:
+    if "tokens" not in message:
+        message["tokens"] = count_tokens(message.get("content")) + 4
+    return message["tokens"]
+
+
+def total_tokens(history: list[dict]) -> int:
+    return sum(message_tokens(m) for m in history)
+
+
+def is_summary(message: dict) -> bool:
+    return bool(message.get("summary"))
+
+
+def for_prompt(history: list[dict]) -> list[dict]:
+    """Strip storage-only fields so messages can be sent to the API."""
+    return [{"role": m["role"], "content": m["content"]} for m in history]
+
+
+def _newest_within(messages: list[dict], budget: int) -> list[dict]:
+    kept, used = [], 0
+    for message in reversed(messages):
+        used += message_tokens(message)
+        if used > budget:
+            break
+        kept.append(message)
+    return kept[::-1]
+
+
+def fit_to_budget(history: list[dict], budget: int) -> list[dict]:
+    """Keep the rolling summary (if any) plus the newest messages that fit in `budget`."""
+    if total_tokens(history) <= budget:
+        return history
+    if history and is_summary(history[0]):
+        summary = history[0]
+        return [summary] + _newest_within(history[1:], budget - message_tokens(summary))
+    return _newest_within(history, budget)
+
+
+async def compact(history: list[dict], budget: int, summarize: Summarizer) -> list[dict]:
+    """
+    If `history` exceeds `budget` tokens, fold the older half of it (and any
+    previous summary) into a single rolling summary message, keeping the
+    newest messages verbatim. Falls back to dropping the oldest messages if
+    summarizing fails.
+    """
+    if total_tokens(history) <= budget:
+        return history
+
+    summary = history[0] if history and is_summary(history[0]) else None
+    rest = history[1:] if summary else history
+    recent = _newest_within(rest, budget // 2)
+    older = rest[: len(rest) - len(recent)]
+    if not older:
+        return fit_to_budget(history, budget)
+
+    try:
+        text = await summarize(([summary] if summary else []) + older)
+    except Exception:
+        logger.warning("Summarizing chat history failed; dropping oldest turns", exc_info=True)
+        return fit_to_budget(history, budget)
+
+    return fit_to_budget([make_message("system", SUMMARY_PREFIX + text, summary=True)] + recent, budget)
@@ -0,0 +1,94 @@
+# whatsapp/dedupe.py
+import asyncio
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+
+
+class MessageDeduper:
+    """
+    Remembers recently seen message ids (e.g. Twilio MessageSid) for `ttl`
+    seconds so redelivered webhooks can be acknowledged without doing the work
+    twice. Entries live in a bounded in-memory LRU; if `db_path` is given they
+    are also recorded in SQLite, which survives restarts and is shared by
+    every process using the same file.
+    """
+
+    def __init__(self, ttl: float = 86400, max_entries: int = 10_000, db_path: str | Path | None = None):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.db_path = Path(db_path) if db_path else None
+        self._seen: OrderedDict[str, float] = OrderedDict()  # key -> expiry
+        self._conn: sqlite3.Connection | None = None
+        self._db_lock = threading.Lock()
+        self._inserts = 0
+        self.duplicates = 0
+
+    # ---------------- SQLite backing ----------------
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            conn = sqlite3.connect(self.db_path, check_same_thread=False, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""
+            CREATE TABLE IF NOT EXISTS seen_messages (
+                message_id TEXT PRIMARY KEY,
+                seen_at REAL NOT NULL
+            )
+            """)
+            self._conn = conn
+        return self._conn
+
+    def _db_check_and_record(self, key: str, now: float) -> bool:
+        with self._db_lock:
+            conn = self._connect()
+            # Expired rows count as unseen
+            conn.execute("DELETE FROM seen_messages WHERE message_id = ? AND seen_at < ?", (key, now - self.ttl))
+            cur = conn.execute("INSERT OR IGNORE INTO seen_messages (message_id, seen_at) VALUES (?, ?)", (key, now))
+            self._inserts += 1
+            if self._inserts % 1000 == 0:
+                conn.execute("DELETE FROM seen_messages WHERE seen_at < ?", (now - self.ttl,))
+            return cur.rowcount == 0
+
+    def _db_forget(self, key: str):
+        with self._db_lock:
+            self._connect().execute("DELETE FROM seen_messages WHERE message_id = ?", (key,))
+
+    # ---------------- public API ----------------
+
+    async def seen_before(self, key: str) -> bool:
+        """Record `key` and return True if it was already recorded within the TTL."""
+        now = time.monotonic()
+        # Entries share one TTL, so the oldest always sit at the front
+        while self._seen:
+            oldest, expiry = next(iter(self._seen.items()))
+            if expiry > now:
+                break
+            del self._seen[oldest]
+
+        if key in self._seen:
+            self._seen.move_to_end(key)
+            self.duplicates += 1
+            return True
+
+        duplicate = False
+        if self.db_path is not None:
+            # Remembered only once the DB write succeeded: if it raises, the
+            # message was not accepted and Twilio's retry must not look like a duplicate
+            duplicate = await asyncio.to_thread(self._db_check_and_record, key, time.time())
+
+        self._seen[key] = now + self.ttl
+        self._seen.move_to_end(key)
+        if len(self._seen) > self.max_entries:
+            self._seen.popitem(last=False)
+        if duplicate:
+            self.duplicates += 1
+        return duplicate
+
+    async def forget(self, key: str):
+        """Drop `key`, e.g. when accepting the message failed and a retry must be processed."""
+        self._seen.pop(key, None)
+        if self.db_path is not None:
+            await asyncio.to_thread(self._db_forget, key)
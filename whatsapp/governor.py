@@ -0,0 +1,213 @@
+# whatsapp/governor.py
+import asyncio
+import json
+import logging
+import random
+import time
+from collections import deque
+from email.utils import parsedate_to_datetime
+import openai
+
+logger = logging.getLogger("openai_governor")
+
+
+class GovernorOverloaded(RuntimeError):
+    """Raised immediately when the wait queue is full (load shedding)."""
+
+
+class TokenBucket:
+    """
+    Refills `rate_per_minute` units per minute, up to `capacity`.
+    Callers reserve units up front and sleep off any deficit, so waiters are
+    served in arrival order. A rate of 0 disables the limit.
+    """
+
+    def __init__(self, rate_per_minute: float, capacity: float | None = None):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = capacity or rate_per_minute
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def reserve(self, amount: float = 1.0) -> float:
+        """Take `amount` units and return how long to wait before using them."""
+        if self.rate <= 0:
+            return 0.0
+        amount = min(amount, self.capacity)
+        self._refill()
+        self._tokens -= amount
+        return max(0.0, -self._tokens / self.rate)
+
+    def refund(self, amount: float = 1.0):
+        if self.rate > 0:
+            self._tokens = min(self.capacity, self._tokens + min(amount, self.capacity))
+
+    async def acquire(self, amount: float = 1.0):
+        delay = self.reserve(amount)
+        if delay:
+            try:
+                await asyncio.sleep(delay)
+            except asyncio.CancelledError:
+                self.refund(amount)
+                raise
+
+
+def estimate_tokens(messages: list[dict], tools: list | None = None, max_output: int = 512) -> int:
+    """Cheap token estimate (~4 characters per token) used for TPM budgeting."""
+    size = len(json.dumps(messages, default=str))
+    if tools:
+        size += len(json.dumps(tools, default=str))
+    return size // 4 + max_output
+
+
+def _retry_after(error: Exception) -> float | None:
+    """Read the server's back-off hint from an OpenAI error response, if any."""
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    headers = response.headers
+    if headers.get("retry-after-ms"):
+        try:
+            return float(headers["retry-after-ms"]) / 1000
+        except ValueError:
+            pass
+    value = headers.get("retry-after")
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        try:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+
+RETRYABLE_ERRORS = (
+    openai.RateLimitError,
+    openai.APITimeoutError,
+    openai.APIConnectionError,
+    openai.InternalServerError,
+)
+
+
+class OpenAIGovernor:
+    """
+    Admission control around chat completions:
+    - token buckets for requests and tokens per minute
+    - at most `max_concurrency` calls in flight, `max_queue` waiting (more are shed)
+    - one deadline per call covering queueing, retries and the request itself
+    - jittered exponential retries that honour retry-after hints
+    """
+
+    def __init__(
+        self,
+        client: openai.AsyncOpenAI,
+        max_concurrency: int = 8,
+        max_queue: int = 100,
+        requests_per_minute: float = 500,
+        tokens_per_minute: float = 200_000,
+        deadline: float = 60.0,
+        max_retries: int = 3,
+        base_backoff: float = 0.5,
+        max_backoff: float = 20.0,
+    ):
+        self.client = client
+        self.max_queue = max_queue
+        self.deadline = deadline
+        self.max_retries = max_retries
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self._slots = asyncio.Semaphore(max(1, max_concurrency))
+        self._requests = TokenBucket(requests_per_minute)
+        self._tokens = TokenBucket(tokens_per_minute)
+        self._paused_until = 0.0
+
+        # Metrics
+        self.queue_depth = 0
+        self.in_flight = 0
+        self.shed = 0
+        self.retries = 0
+        self.timeouts = 0
+        self.completed = 0
+        self._waits: deque[float] = deque(maxlen=500)
+
+    async def chat_completion(self, **kwargs):
+        """Governed equivalent of `client.chat.completions.create(**kwargs)`."""
+        if self.queue_depth >= self.max_queue:
+            self.shed += 1
+            raise GovernorOverloaded("OpenAI request queue is full")
+
+        cost = estimate_tokens(kwargs.get("messages", []), kwargs.get("tools"))
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.deadline
+        try:
+            async with asyncio.timeout_at(deadline):
+                return await self._admit_and_call(kwargs, cost, deadline)
+        except TimeoutError:
+            self.timeouts += 1
+            raise
+
+    async def _admit_and_call(self, kwargs: dict, cost: int, deadline: float):
+        loop = asyncio.get_running_loop()
+        queued_at = loop.time()
+        self.queue_depth += 1
+        try:
+            await self._slots.acquire()
+        finally:
+            self.queue_depth -= 1
+        self.in_flight += 1
+        try:
+            attempt = 0
+            while True:
+                pause = self._paused_until - loop.time()
+                if pause > 0:
+                    await asyncio.sleep(pause)
+                await self._requests.acquire(1)
+                await self._tokens.acquire(cost)
+                if attempt == 0:
+                    self._waits.append(loop.time() - queued_at)
+                try:
+                    response = await self.client.chat.completions.create(
+                        timeout=max(1.0, deadline - loop.time()),
+                        **kwargs,
+                    )
+                    self.completed += 1
+                    return response
+                except RETRYABLE_ERRORS as e:
+                    if attempt >= self.max_retries:
+                        raise
+                    attempt += 1
+                    self.retries += 1
+                    hint = _retry_after(e)
+                    backoff = random.uniform(0, min(self.max_backoff, self.base_backoff * 2 ** attempt))
+                    delay = max(hint or 0.0, backoff)
+                    if hint and isinstance(e, openai.RateLimitError):
+                        # Server told us to back off: hold every caller, not just this one
+                        self._paused_until = max(self._paused_until, loop.time() + hint)
+                    logger.warning("OpenAI call failed (%s), retry %d in %.2fs", type(e).__name__, attempt, delay)
+                    await asyncio.sleep(delay)
+        finally:
+            self.in_flight -= 1
+            self._slots.release()
+
+    def snapshot(self) -> dict:
+        waits = sorted(self._waits)
+        return {
+            "queue_depth": self.queue_depth,
+            "in_flight": self.in_flight,
+            "completed": self.completed,
+            "shed": self.shed,
+            "retries": self.retries,
+            "timeouts": self.timeouts,
+            "wait_seconds": {
+                "samples": len(waits),
+                "avg": sum(waits) / len(waits) if waits else 0.0,
+                "p95": waits[int(len(waits) * 0.95) - 1] if waits else 0.0,
+                "max": waits[-1] if waits else 0.0,
+            },
+        }
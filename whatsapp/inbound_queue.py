@@ -0,0 +1,392 @@
+# whatsapp/inbound_queue.py
+import asyncio
+import logging
+import random
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Awaitable, Callable
+
+logger = logging.getLogger("inbound_queue")
+
+Handler = Callable[[str, str], Awaitable[str | None]]
+Sender = Callable[[str, str], Awaitable[None]]
+
+
+class QueueFull(Exception):
+    """The queue already holds `max_depth` unfinished messages."""
+
+
+class InboundQueue:
+    """
+    Durable queue of inbound WhatsApp messages with a fixed-size worker pool.
+    Messages are persisted in SQLite before the webhook acknowledges them,
+    retried with backoff when the handler fails and moved to status 'dead'
+    after `max_attempts`. A user's messages are handed out one at a time and
+    oldest first, so per-user ordering survives retries and restarts.
+
+    A turn runs in two stages: `handler(user_number, text)` produces the reply,
+    which is stored with the messages, then `sender(user_number, reply)`
+    delivers it. If only the send fails, the retry resends the stored reply
+    instead of running the handler again. A handler returning None has
+    nothing to send. With `max_depth` set, enqueue raises QueueFull once that
+    many messages are waiting or being processed.
+
+    With `hold_replies`, a reply whose user wrote again while it was being
+    generated is stored in `held_replies` instead of being sent, and goes out
+    together with the reply to the newer messages. Held replies are deleted
+    only once a send that included them succeeded.
+
+    With `debounce` > 0 a user's messages are held until they have been quiet
+    for `debounce` seconds (or the oldest has waited `max_debounce`), then all
+    of them are handed to the handler as one turn, joined by newlines.
+    """
+
+    def __init__(
+        self,
+        db_path: str | Path,
+        handler: Handler,
+        sender: Sender,
+        workers: int = 4,
+        max_attempts: int = 5,
+        retry_backoff: float = 2.0,
+        poll_interval: float = 1.0,
+        debounce: float = 0.0,
+        max_debounce: float | None = None,
+        max_depth: int | None = None,
+        hold_replies: bool = False,
+    ):
+        self.db_path = Path(db_path)
+        self.handler = handler
+        self.sender = sender
+        self.workers = max(1, workers)
+        self.max_attempts = max_attempts
+        self.retry_backoff = retry_backoff
+        self.debounce = debounce
+        self.max_debounce = max_debounce if max_debounce is not None else debounce * 4
+        self.max_depth = max_depth
+        self.hold_replies = hold_replies
+        # Poll often enough that a burst is released soon after its window closes
+        self.poll_interval = min(poll_interval, debounce / 4) if debounce > 0 else poll_interval
+        self._conn: sqlite3.Connection | None = None
+        self._db_lock = threading.Lock()
+        self._wakeup = asyncio.Event()
+        self._stopping = False
+        self._tasks: list[asyncio.Task] = []
+
+        # Metrics
+        self.busy_workers = 0
+        self.processed = 0
+        self.failed_attempts = 0
+        self.coalesced = 0
+        self.rejected = 0
+        self.resent = 0
+        self.held = 0
+
+    # ---------------- storage ----------------
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            conn = sqlite3.connect(self.db_path, check_same_thread=False, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("""
+            CREATE TABLE IF NOT EXISTS inbound_messages (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_number TEXT NOT NULL,
+                body TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt_at REAL NOT NULL,
+                last_error TEXT,
+                created_at REAL NOT NULL,
+                reply TEXT
+            )
+            """)
+            conn.execute("""
+            CREATE TABLE IF NOT EXISTS held_replies (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_number TEXT NOT NULL,
+                reply TEXT NOT NULL,
+                created_at REAL NOT NULL
+            )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS ix_held_user ON held_replies (user_number, id)")
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(inbound_messages)")}
+            if "reply" not in columns:  # queue files created before replies were stored
+                conn.execute("ALTER TABLE inbound_messages ADD COLUMN reply TEXT")
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS ix_inbound_status_user "
+                "ON inbound_messages (status, user_number, id)"
+            )
+            self._conn = conn
+        return self._conn
+
+    def _run(self, fn, *args):
+        with self._db_lock:
+            return fn(self._connect(), *args)
+
+    async def _db(self, fn, *args):
+        return await asyncio.to_thread(self._run, fn, *args)
+
+    @staticmethod
+    def _insert(conn, user_number, body, max_depth):
+        now = time.time()
+        if max_depth is not None:
+            depth = conn.execute(
+                "SELECT COUNT(*) FROM inbound_messages WHERE status IN ('pending', 'processing')"
+            ).fetchone()[0]
+            if depth >= max_depth:
+                raise QueueFull(f"inbound queue holds {depth} messages")
+        cur = conn.execute(
+            "INSERT INTO inbound_messages (user_number, body, next_attempt_at, created_at) VALUES (?, ?, ?, ?)",
+            (user_number, body, now, now),
+        )
+        return cur.lastrowid
+
+    @staticmethod
+    def _claim(conn, debounce, max_debounce):
+        """
+        Claim every pending message of the next ready user.
+        Returns (ids, user_number, bodies, reply); `reply` is set when an
+        earlier attempt already produced it and only the send is retried.
+        """
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                """
+                SELECT m.user_number FROM inbound_messages m
+                WHERE m.status = 'pending' AND m.next_attempt_at <= ?
+                  AND m.id = (
+                      SELECT MIN(o.id) FROM inbound_messages o
+                      WHERE o.user_number = m.user_number AND o.status IN ('pending', 'processing')
+                  )
+                  AND (
+                      m.created_at <= ?
+                      OR (SELECT MAX(n.created_at) FROM inbound_messages n
+                          WHERE n.user_number = m.user_number AND n.status = 'pending') <= ?
+                  )
+                ORDER BY m.id LIMIT 1
+                """,
+                (now, now - max_debounce, now - debounce),
+            ).fetchone()
+            claimed = None
+            if row:
+                user_number = row[0]
+                messages = conn.execute(
+                    "SELECT id, body, reply FROM inbound_messages "
+                    "WHERE user_number = ? AND status = 'pending' ORDER BY id",
+                    (user_number,),
+                ).fetchall()
+                reply = messages[0][2]
+                if reply is not None:
+                    # Resend the answered turn on its own; newer messages get their own turn
+                    messages = [m for m in messages if m[2] is not None]
+                ids = [message_id for message_id, _, _ in messages]
+                conn.executemany(
+                    "UPDATE inbound_messages SET status = 'processing', attempts = attempts + 1 WHERE id = ?",
+                    [(message_id,) for message_id in ids],
+                )
+                claimed = (ids, user_number, [body for _, body, _ in messages], reply)
+            conn.execute("COMMIT")
+            return claimed
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    @staticmethod
+    def _save_reply(conn, ids, user_number, reply, hold):
+        """
+        Store the reply of a claimed turn. With `hold`, a user who has newer
+        pending messages gets it moved to held_replies and the turn is
+        finished; returns True in that case.
+        """
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            held = hold and InboundQueue._has_pending(conn, user_number)
+            if held:
+                conn.execute(
+                    "INSERT INTO held_replies (user_number, reply, created_at) VALUES (?, ?, ?)",
+                    (user_number, reply, time.time()),
+                )
+                InboundQueue._complete(conn, ids)
+            else:
+                conn.executemany(
+                    "UPDATE inbound_messages SET reply = ? WHERE id = ?",
+                    [(reply, message_id) for message_id in ids],
+                )
+            conn.execute("COMMIT")
+            return held
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    @staticmethod
+    def _held(conn, user_number):
+        """Held replies of a user, oldest first, as (ids, replies)."""
+        rows = conn.execute(
+            "SELECT id, reply FROM held_replies WHERE user_number = ? ORDER BY id", (user_number,)
+        ).fetchall()
+        return [held_id for held_id, _ in rows], [reply for _, reply in rows]
+
+    @staticmethod
+    def _complete(conn, ids, held_ids=()):
+        conn.executemany("DELETE FROM inbound_messages WHERE id = ?", [(message_id,) for message_id in ids])
+        conn.executemany("DELETE FROM held_replies WHERE id = ?", [(held_id,) for held_id in held_ids])
+
+    @staticmethod
+    def _fail(conn, ids, error, max_attempts, backoff):
+        """Reschedule (or dead-letter) a failed batch; returns True if dead-lettered."""
+        attempts = conn.execute(
+            f"SELECT MAX(attempts) FROM inbound_messages WHERE id IN ({','.join('?' * len(ids))})", ids
+        ).fetchone()[0]
+        if attempts >= max_attempts:
+            conn.executemany(
+                "UPDATE inbound_messages SET status = 'dead', last_error = ? WHERE id = ?",
+                [(error, message_id) for message_id in ids],
+            )
+            return True
+        delay = backoff * 2 ** (attempts - 1) * random.uniform(0.5, 1.5)
+        conn.executemany(
+            "UPDATE inbound_messages SET status = 'pending', last_error = ?, next_attempt_at = ? WHERE id = ?",
+            [(error, time.time() + delay, message_id) for message_id in ids],
+        )
+        return False
+
+    @staticmethod
+    def _has_pending(conn, user_number):
+        row = conn.execute(
+            "SELECT 1 FROM inbound_messages WHERE user_number = ? AND status = 'pending' LIMIT 1",
+            (user_number,),
+        ).fetchone()
+        return row is not None
+
+    @staticmethod
+    def _requeue_in_flight(conn):
+        conn.execute("UPDATE inbound_messages SET status = 'pending' WHERE status = 'processing'")
+
+    @staticmethod
+    def _counts(conn):
+        rows = conn.execute("SELECT status, COUNT(*), MIN(created_at) FROM inbound_messages GROUP BY status").fetchall()
+        counts = {status: (count, oldest) for status, count, oldest in rows}
+        counts["held"] = conn.execute("SELECT COUNT(*), MIN(created_at) FROM held_replies").fetchone()
+        return counts
+
+    # ---------------- public API ----------------
+
+    async def enqueue(self, user_number: str, body: str) -> int:
+        """Persist a message and wake a worker. Returns the queue row id; raises QueueFull."""
+        try:
+            message_id = await self._db(self._insert, user_number, body, self.max_depth)
+        except QueueFull:
+            self.rejected += 1
+            raise
+        self._wakeup.set()
+        return message_id
+
+    async def start(self):
+        if self._tasks:
+            return
+        self._stopping = False
+        # Anything left 'processing' was interrupted by a crash or restart
+        await self._db(self._requeue_in_flight)
+        self._tasks = [asyncio.create_task(self._worker(i)) for i in range(self.workers)]
+        logger.info("Inbound queue started with %d workers", self.workers)
+
+    async def stop(self, drain_timeout: float = 25.0):
+        """Stop claiming new messages and give in-flight ones time to finish."""
+        if not self._tasks:
+            return
+        self._stopping = True
+        self._wakeup.set()
+        done, pending = await asyncio.wait(self._tasks, timeout=drain_timeout)
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        # Interrupted messages are picked up again on the next start
+        await self._db(self._requeue_in_flight)
+        self._tasks = []
+
+    async def _worker(self, index: int):
+        while not self._stopping:
+            # Clear before claiming so an enqueue racing with the claim is not missed
+            self._wakeup.clear()
+            claimed = await self._db(self._claim, self.debounce, self.max_debounce)
+            if claimed is None:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            ids, user_number, bodies, reply = claimed
+            if len(ids) > 1 and reply is None:
+                self.coalesced += len(ids) - 1
+            self.busy_workers += 1
+            generating = reply is None
+            held_ids = []
+            try:
+                if generating:
+                    reply = await self.handler(user_number, "\n".join(bodies))
+                    generating = False
+                    # Stored first, so a failed send is retried without a new turn
+                    if reply is not None and await self._db(
+                        self._save_reply, ids, user_number, reply, self.hold_replies
+                    ):
+                        self.held += 1
+                        self.processed += len(ids)
+                        logger.info("Holding reply to %s until their newer messages are answered", user_number)
+                        continue
+                else:
+                    self.resent += 1
+                if reply is not None:
+                    held_ids, held = await self._db(self._held, user_number)
+                    await self.sender(user_number, "\n\n".join(held + [reply]))
+            except Exception as e:
+                self.failed_attempts += 1
+                dead = await self._db(self._fail, ids, repr(e), self.max_attempts, self.retry_backoff)
+                if dead:
+                    logger.error("Inbound messages %s for %s dead after %d attempts", ids, user_number, self.max_attempts)
+                else:
+                    logger.warning("Inbound messages %s for %s failed, will retry: %r", ids, user_number, e)
+                if generating:
+                    # Don't leave earlier answers stranded behind a failing turn
+                    await self._send_held(user_number)
+            else:
+                await self._db(self._complete, ids, held_ids)
+                self.processed += len(ids)
+            finally:
+                self.busy_workers -= 1
+                # Another message for this user may have become claimable
+                self._wakeup.set()
+
+    async def _send_held(self, user_number: str):
+        try:
+            held_ids, held = await self._db(self._held, user_number)
+            if held:
+                await self.sender(user_number, "\n\n".join(held))
+                await self._db(self._complete, [], held_ids)
+        except Exception as e:
+            logger.warning("Held replies for %s not sent, kept for the next turn: %r", user_number, e)
+
+    async def snapshot(self) -> dict:
+        counts = await self._db(self._counts)
+        pending, oldest = counts.get("pending", (0, None))
+        return {
+            "pending": pending,
+            "processing": counts.get("processing", (0, None))[0],
+            "dead": counts.get("dead", (0, None))[0],
+            "held_replies": counts["held"][0],
+            "oldest_pending_age_seconds": time.time() - oldest if oldest else 0.0,
+            "workers": len(self._tasks),
+            "busy_workers": self.busy_workers,
+            "processed": self.processed,
+            "failed_attempts": self.failed_attempts,
+            "coalesced": self.coalesced,
+            "resent": self.resent,
+            "held": self.held,
+            "rejected": self.rejected,
+            "max_depth": self.max_depth,
+        }
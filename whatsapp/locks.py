@@ -0,0 +1,32 @@
+# whatsapp/locks.py
+import asyncio
+from contextlib import asynccontextmanager
+
+
+class KeyedLock:
+    """
+    One asyncio.Lock per key (e.g. per WhatsApp user).
+    Holders of the same key run strictly one after another, in arrival order;
+    different keys never wait on each other. An entry is dropped as soon as
+    nobody holds or waits on it, so memory is bounded by active keys only.
+    """
+
+    def __init__(self):
+        self._entries: dict[str, list] = {}  # key -> [lock, holders + waiters]
+
+    @asynccontextmanager
+    async def hold(self, key: str):
+        entry = self._entries.get(key)
+        if entry is None:
+            entry = self._entries[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._entries[key]
+
+    def __len__(self) -> int:
+        return len(self._entries)
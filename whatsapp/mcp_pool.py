@@ -0,0 +1,199 @@
+# whatsapp/mcp_pool.py
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+import anyio
+from mcp import ClientSession
+from mcp.client.stdio import stdio_client, StdioServerParameters
+from mcp.shared.exceptions import McpError
+
+logger = logging.getLogger("mcp_pool")
+
+# Errors that mean the session itself is broken (dead process, closed
+# streams, protocol failure). Anything else raised while a session is
+# borrowed is the caller's problem and leaves the session in the pool.
+SESSION_ERRORS = (
+    McpError,
+    anyio.ClosedResourceError,
+    anyio.BrokenResourceError,
+    anyio.EndOfStream,
+    asyncio.TimeoutError,
+    OSError,
+)
+
+
+class _PooledSession:
+    """
+    One long-lived MCP stdio session.
+    The stdio transport must be entered and exited from the same task, so each
+    session is owned by a background task that keeps it open until closed.
+    """
+
+    def __init__(self, params: StdioServerParameters):
+        self.params = params
+        self.session: ClientSession | None = None
+        self.in_use = False
+        self._task: asyncio.Task | None = None
+        self._ready = asyncio.Event()
+        self._stop = asyncio.Event()
+        self._error: BaseException | None = None
+
+    @property
+    def alive(self) -> bool:
+        return self.session is not None and self._task is not None and not self._task.done()
+
+    async def _run(self):
+        try:
+            async with stdio_client(self.params) as (read_stream, write_stream):
+                async with ClientSession(read_stream, write_stream) as session:
+                    await session.initialize()
+                    self.session = session
+                    self._ready.set()
+                    await self._stop.wait()
+        except Exception as e:
+            self._error = e
+            logger.warning("MCP session exited: %r", e)
+        finally:
+            self.session = None
+            self._ready.set()
+
+    async def ensure_started(self, timeout: float):
+        """Start (or restart) the underlying server process if it is not running."""
+        if self.alive:
+            return
+        await self.close()
+        self._ready = asyncio.Event()
+        self._stop = asyncio.Event()
+        self._error = None
+        self._task = asyncio.create_task(self._run())
+        try:
+            await asyncio.wait_for(self._ready.wait(), timeout)
+        except asyncio.TimeoutError:
+            await self.close()
+            raise RuntimeError("MCP server did not initialize in time")
+        if self.session is None:
+            raise RuntimeError(f"MCP server failed to start: {self._error!r}")
+
+    async def ping(self, timeout: float):
+        await asyncio.wait_for(self.session.send_ping(), timeout)
+
+    async def close(self):
+        if self._task is None:
+            return
+        self._stop.set()
+        try:
+            await asyncio.wait_for(asyncio.shield(self._task), 5)
+        except Exception:
+            self._task.cancel()
+        self._task = None
+        self.session = None
+
+
+class MCPSessionPool:
+    """
+    Fixed-size pool of initialized MCP client sessions.
+    Sessions are started lazily, pinged periodically while idle and restarted
+    when their server process dies, so tool calls reuse warm sessions.
+    """
+
+    def __init__(
+        self,
+        params: StdioServerParameters,
+        size: int = 2,
+        healthcheck_interval: float = 30.0,
+        start_timeout: float = 20.0,
+    ):
+        self.params = params
+        self.size = max(1, size)
+        self.healthcheck_interval = healthcheck_interval
+        self.start_timeout = start_timeout
+        self._slots: list[_PooledSession] = []
+        self._idle: asyncio.Queue | None = None
+        self._health_task: asyncio.Task | None = None
+        self._lock = asyncio.Lock()
+
+    async def start(self):
+        if self._idle is not None:
+            return
+        async with self._lock:
+            if self._idle is not None:
+                return
+            idle = asyncio.Queue()
+            self._slots = [_PooledSession(self.params) for _ in range(self.size)]
+            results = await asyncio.gather(
+                *(slot.ensure_started(self.start_timeout) for slot in self._slots),
+                return_exceptions=True,
+            )
+            for slot, result in zip(self._slots, results):
+                if isinstance(result, Exception):
+                    logger.warning("MCP session warm-up failed: %r", result)
+                idle.put_nowait(slot)
+            if self.healthcheck_interval > 0:
+                self._health_task = asyncio.create_task(self._health_loop())
+            self._idle = idle
+
+    @asynccontextmanager
+    async def session(self):
+        """Borrow a live ClientSession; it is returned to the pool on exit."""
+        await self.start()
+        idle = self._idle
+        slot = await idle.get()
+        slot.in_use = True
+        try:
+            try:
+                await slot.ensure_started(self.start_timeout)
+            except Exception:
+                await slot.close()
+                raise
+            try:
+                yield slot.session
+            except SESSION_ERRORS:
+                # The session may be half-way through a request; recycle it
+                await slot.close()
+                raise
+        finally:
+            slot.in_use = False
+            if self._idle is idle:
+                idle.put_nowait(slot)
+            else:
+                # The pool was closed while this session was borrowed
+                await slot.close()
+
+    async def _health_loop(self):
+        while True:
+            await asyncio.sleep(self.healthcheck_interval)
+            idle = self._idle
+            if idle is None:
+                return
+            # Take idle slots out of the queue while checking them, so no
+            # borrower can pick one up mid-restart
+            checking = []
+            while True:
+                try:
+                    checking.append(idle.get_nowait())
+                except asyncio.QueueEmpty:
+                    break
+            try:
+                for slot in checking:
+                    try:
+                        if slot.alive:
+                            await slot.ping(timeout=5)
+                        else:
+                            await slot.ensure_started(self.start_timeout)
+                    except Exception as e:
+                        logger.warning("MCP session failed health check, restarting: %r", e)
+                        await slot.close()
+            finally:
+                if self._idle is idle:
+                    for slot in checking:
+                        idle.put_nowait(slot)
+
+    async def close(self):
+        if self._health_task is not None:
+            self._health_task.cancel()
+            await asyncio.gather(self._health_task, return_exceptions=True)
+            self._health_task = None
+        for slot in self._slots:
+            await slot.close()
+        self._slots = []
+        self._idle = None
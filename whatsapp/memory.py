@@ -1,9 +1,17 @@
+import asyncio
 import json
+import logging
+import os
 import sqlite3
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 DB_PATH = Path("chat_memory.db")
 
+logger = logging.getLogger("chat_memory")
+
+
 def init_memory_db():
     with sqlite3.connect(DB_PATH) as conn:
         conn.execute("""
@@ -14,17 +22,139 @@ def init_memory_db():
         """)
         conn.commit()
 
-def load_memory(user_id):
-    with sqlite3.connect(DB_PATH) as conn:
-        row = conn.execute("SELECT history FROM memory WHERE user_id = ?", (user_id,)).fetchone()
-        if row:
-            return json.loads(row[0])
-    return []
 
-def save_memory(user_id, messages):
-    with sqlite3.connect(DB_PATH) as conn:
-        conn.execute(
-            "REPLACE INTO memory (user_id, history) VALUES (?, ?)",
-            (user_id, json.dumps(messages[-20:])),
-        )
-        conn.commit()
+class MemoryStore:
+    """
+    Chat history store that keeps SQLite I/O off the event loop.
+    - One persistent WAL-mode connection, owned by a dedicated thread
+    - Read-through LRU of the `cache_size` most recent conversations
+    - durability="batched": saves update the cache and are flushed to disk
+      together every `flush_interval` seconds (write-behind)
+      durability="sync": every save is committed before it returns
+    """
+
+    def __init__(
+        self,
+        db_path: str | Path = DB_PATH,
+        cache_size: int = 1000,
+        durability: str = "batched",
+        flush_interval: float = 0.5,
+    ):
+        self.db_path = Path(db_path)
+        self.cache_size = cache_size
+        self.durability = durability
+        self.flush_interval = flush_interval
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="chat-memory")
+        self._conn: sqlite3.Connection | None = None
+        self._cache: OrderedDict[str, list] = OrderedDict()
+        self._dirty: dict[str, list] = {}
+        self._flush_task: asyncio.Task | None = None
+
+    # ---------------- database thread ----------------
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            conn = sqlite3.connect(self.db_path, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=" + ("FULL" if self.durability == "sync" else "NORMAL"))
+            conn.execute("""
+            CREATE TABLE IF NOT EXISTS memory (
+                user_id TEXT PRIMARY KEY,
+                history TEXT
+            )
+            """)
+            self._conn = conn
+        return self._conn
+
+    def _read(self, user_id: str) -> list:
+        row = self._connect().execute("SELECT history FROM memory WHERE user_id = ?", (user_id,)).fetchone()
+        return json.loads(row[0]) if row else []
+
+    def _write(self, rows: list[tuple[str, str]]):
+        conn = self._connect()
+        with conn:
+            conn.executemany("REPLACE INTO memory (user_id, history) VALUES (?, ?)", rows)
+
+    async def _in_thread(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    # ---------------- cache ----------------
+
+    def _remember(self, user_id: str, messages: list):
+        self._cache[user_id] = messages
+        self._cache.move_to_end(user_id)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    # ---------------- public API ----------------
+
+    async def load(self, user_id: str) -> list:
+        messages = self._dirty.get(user_id)
+        if messages is None:
+            messages = self._cache.get(user_id)
+        if messages is None:
+            messages = await self._in_thread(self._read, user_id)
+        self._remember(user_id, messages)
+        return list(messages)
+
+    async def save(self, user_id: str, messages: list):
+        # Size is bounded by the bot's token-budgeted compaction
+        messages = list(messages)
+        self._remember(user_id, messages)
+        if self.durability == "sync":
+            await self._in_thread(self._write, [(user_id, json.dumps(messages))])
+            return
+        self._dirty[user_id] = messages
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        # Keeps retrying (with capped backoff) until the pending saves are on disk
+        delay = self.flush_interval
+        while True:
+            await asyncio.sleep(delay)
+            try:
+                await self.flush()
+            except Exception:
+                delay = min(delay * 2, 30.0)  # flush() logged it and kept the batch
+                continue
+            if not self._dirty:
+                return
+            delay = self.flush_interval
+
+    async def flush(self):
+        """Write every pending save to disk in one transaction."""
+        if not self._dirty:
+            return
+        batch, self._dirty = self._dirty, {}
+        try:
+            await self._in_thread(self._write, [(user_id, json.dumps(msgs)) for user_id, msgs in batch.items()])
+        except Exception:
+            # Keep the unsaved histories (unless superseded) for the next flush
+            for user_id, msgs in batch.items():
+                self._dirty.setdefault(user_id, msgs)
+            logger.exception("Failed to flush chat memory")
+            raise
+
+    async def close(self):
+        if self._flush_task is not None and not self._flush_task.done():
+            self._flush_task.cancel()
+        await self.flush()
+        if self._conn is not None:
+            await self._in_thread(self._conn.close)
+            self._conn = None
+
+
+MEMORY_STORE = MemoryStore(
+    cache_size=int(os.getenv("MEMORY_CACHE_SIZE", "1000")),
+    durability=os.getenv("MEMORY_DURABILITY", "batched"),
+    flush_interval=float(os.getenv("MEMORY_FLUSH_INTERVAL", "0.5")),
+)
+
+
+async def load_memory(user_id):
+    return await MEMORY_STORE.load(user_id)
+
+
+async def save_memory(user_id, messages):
+    await MEMORY_STORE.save(user_id, messages)
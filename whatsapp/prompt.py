@@ -0,0 +1,51 @@
+# whatsapp/prompt.py
+import re
+from app.catalog import CATALOG
+
+# (catalog version, instructions) -> system prompt; rebuilt only when business.json changes
+_CACHE: dict = {"key": None, "prompt": None}
+
+
+def _short_duration(text: str) -> str:
+    """'1 hr 15 mins' -> '75m'; unknown formats are returned unchanged."""
+    hours = re.search(r"(\d+)\s*hr", text)
+    minutes = re.search(r"(\d+)\s*min", text)
+    if not hours and not minutes:
+        return text
+    total = int(hours.group(1)) * 60 if hours else 0
+    total += int(minutes.group(1)) if minutes else 0
+    return f"{total}m"
+
+
+def build_catalog(data: dict) -> str:
+    """Token-lean catalog: one line per category, `name price/duration` per item."""
+    lines = [
+        f"Hours: {data.get('operating_hours', '')}",
+        f"Location: {data.get('location', '')}",
+        f"Contact: {data.get('contact_number', '')}",
+        "Services (price KES/duration):",
+    ]
+    for category in data.get("services", []):
+        items = "; ".join(
+            f"{item['name']} {item['price']}/{_short_duration(item.get('duration', ''))}"
+            for item in category.get("items", [])
+        )
+        lines.append(f"{category.get('category', '')}: {items}")
+    return "\n".join(lines)
+
+
+def system_prompt(instructions: str) -> str:
+    """
+    Static instructions followed by the catalog. The result is byte-identical
+    between requests until business.json changes, so the provider's prompt
+    cache can reuse the whole prefix.
+    """
+    try:
+        data = CATALOG.data
+    except (OSError, ValueError):
+        return instructions
+    key = (CATALOG.version, instructions)
+    if _CACHE["key"] != key:
+        _CACHE["prompt"] = f"{instructions}\n\nBusiness catalog:\n{build_catalog(data)}"
+        _CACHE["key"] = key
+    return _CACHE["prompt"]
@@ -0,0 +1,49 @@
+# whatsapp/tool_dispatch.py
+import json
+from contextlib import asynccontextmanager
+from mcp.types import CallToolResult, ListToolsResult, TextContent
+
+
+class InProcessToolSession:
+    """
+    Stand-in for mcp.ClientSession that calls the FastMCP tools in
+    mcp_server/tools.py directly. The tools' HTTP requests are served
+    in-memory by the FastAPI app instead of going over loopback TCP.
+    """
+
+    def __init__(self):
+        # Imported lazily: app.main imports the WhatsApp router, which imports the bot
+        from app.main import app
+        from mcp_server import tools
+
+        tools.use_asgi_app(app)
+        self._server = tools.mcp
+
+    async def list_tools(self) -> ListToolsResult:
+        return ListToolsResult(tools=await self._server.list_tools())
+
+    async def call_tool(self, name: str, arguments: dict | None = None) -> CallToolResult:
+        try:
+            result = await self._server.call_tool(name, arguments or {})
+        except Exception as e:
+            # Same shape the MCP server sends back for a failing tool
+            return CallToolResult(content=[TextContent(type="text", text=str(e))], isError=True)
+
+        if isinstance(result, CallToolResult):
+            return result
+        if isinstance(result, tuple):
+            result = result[0]
+        if isinstance(result, dict):
+            result = [TextContent(type="text", text=json.dumps(result))]
+        return CallToolResult(content=list(result), isError=False)
+
+
+_INPROCESS_SESSION: InProcessToolSession | None = None
+
+
+@asynccontextmanager
+async def inprocess_session():
+    global _INPROCESS_SESSION
+    if _INPROCESS_SESSION is None:
+        _INPROCESS_SESSION = InProcessToolSession()
+    yield _INPROCESS_SESSION
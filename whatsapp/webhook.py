@@ -1,10 +1,12 @@
 
 # whatsapp/webhook.py
-import asyncio
+import os
 from fastapi import APIRouter, Form, Request
-from fastapi.responses import PlainTextResponse
-from whatsapp.client import send_whatsapp_message
-from whatsapp.bot import chat_with_bot  # your async function from bot.py
+from fastapi.responses import PlainTextResponse, Response
+from whatsapp.client import send_whatsapp_message, TWILIO_SENDER
+from whatsapp.bot import chat_with_bot, OPENAI_GOVERNOR  # your async function from bot.py
+from whatsapp.inbound_queue import InboundQueue, QueueFull
+from whatsapp.dedupe import MessageDeduper
 import logging
 
 router = APIRouter(prefix="/whatsapp", tags=["WhatsApp"])
@@ -12,52 +14,107 @@ router = APIRouter(prefix="/whatsapp", tags=["WhatsApp"])
 logger = logging.getLogger("whatsapp_webhook")
 logging.basicConfig(level=logging.INFO)
 
+# Twilio redelivers webhooks it considers slow or failed; remember MessageSids
+# so each inbound message is processed exactly once
+MESSAGE_DEDUPER = MessageDeduper(
+    ttl=float(os.getenv("WEBHOOK_DEDUPE_TTL", "86400")),
+    db_path=os.getenv("WEBHOOK_DEDUPE_DB") or None,
+)
+
+
+def _twilio_ack() -> Response:
+    """Empty TwiML: tells Twilio the message was accepted without sending a reply."""
+    return Response(content="<Response></Response>", media_type="application/xml")
+
 
 @router.post("/webhook")
 async def whatsapp_webhook(
     request: Request,
     From: str = Form(...),
     Body: str = Form(...),
+    MessageSid: str | None = Form(None),
 ):
     """
     Twilio WhatsApp webhook endpoint.
-    Twilio sends form-encoded fields including 'From' and 'Body'.
-    We schedule the processing asynchronously and return quickly.
+    Twilio sends form-encoded fields including 'From', 'Body' and 'MessageSid'.
+    The message is persisted to the inbound queue and processed by the
+    worker pool, so we return quickly and nothing is lost on restart.
+    Redeliveries of an already accepted MessageSid are acknowledged and ignored.
+    When the queue is full we answer 503 so Twilio retries later.
     """
     try:
         user_number = From.replace("whatsapp:", "").strip()
         user_message = Body.strip()
 
+        if MessageSid and await MESSAGE_DEDUPER.seen_before(MessageSid):
+            logger.info("Duplicate delivery of %s from %s ignored", MessageSid, user_number)
+            return _twilio_ack()
+
         logger.info("Incoming message from %s: %s", user_number, user_message)
 
-        # Schedule processing in the event loop (non-blocking for Twilio)
-        asyncio.create_task(_process_and_reply(user_number, user_message))
+        # Persist for the worker pool (non-blocking for Twilio)
+        try:
+            await INBOUND_QUEUE.enqueue(user_number, user_message)
+        except Exception as e:
+            # Not accepted, so Twilio's retry must not be treated as a duplicate
+            if MessageSid:
+                await MESSAGE_DEDUPER.forget(MessageSid)
+            if isinstance(e, QueueFull):
+                logger.warning("Inbound queue full, deferring message from %s", user_number)
+                return PlainTextResponse("BUSY", status_code=503, headers={"Retry-After": QUEUE_RETRY_AFTER})
+            raise
 
         # Immediately acknowledge to Twilio
-        #return PlainTextResponse("OK", status_code=200)
+        return _twilio_ack()
 
     except Exception as e:
         logger.exception("Webhook error")
         return PlainTextResponse("ERROR", status_code=500)
 
 
-async def _process_and_reply(user_number: str, user_message: str):
+async def _generate_reply(user_number: str, user_message: str) -> str:
     """
-    Coroutine that calls your bot, then sends reply via Twilio.
-    Runs in background (scheduled with create_task).
+    Coroutine that calls your bot and returns the reply for _send_reply.
+    Runs on an inbound queue worker; raising makes the queue retry the message.
+    `user_message` may be several messages of one burst joined by newlines.
     """
-    try:
-        # Get bot reply (calls MCP + OpenAI via your bot.chat_with_bot)
-        bot_reply = await chat_with_bot(user_message)
+    # Get bot reply (calls MCP + OpenAI via your bot.chat_with_bot)
+    bot_reply = await chat_with_bot(user_message, user_id=user_number)
+    if not bot_reply:
+        bot_reply = "Sorry, I couldn't process your request right now. Please try again."
+    return bot_reply
 
-        if not bot_reply:
-            bot_reply = "Sorry, I couldn't process your request right now. Please try again."
 
-        # Send WhatsApp message (async wrapper)
-        sid = await send_whatsapp_message(user_number, bot_reply)
-        logger.info("Replied to %s, message SID: %s", user_number, sid)
+async def _send_reply(user_number: str, reply: str):
+    """Send a generated reply via Twilio; on failure the queue retries just this send."""
+    sid = await send_whatsapp_message(user_number, reply)
+    logger.info("Replied to %s, message SID: %s", user_number, sid)
+
+
+INBOUND_QUEUE = InboundQueue(
+    os.getenv("INBOUND_QUEUE_DB", "inbound_queue.db"),
+    _generate_reply,
+    _send_reply,
+    workers=int(os.getenv("INBOUND_WORKERS", "4")),
+    max_attempts=int(os.getenv("INBOUND_MAX_ATTEMPTS", "5")),
+    # Quiet period that merges a burst of messages into one bot turn
+    debounce=float(os.getenv("WHATSAPP_DEBOUNCE_SECONDS", "2")),
+    max_debounce=float(os.getenv("WHATSAPP_DEBOUNCE_MAX_SECONDS", "8")),
+    # Beyond this many unfinished messages the webhook sheds load with a 503
+    max_depth=int(os.getenv("INBOUND_MAX_DEPTH", "1000")),
+    # The user wrote again meanwhile: merge the reply into the next one
+    # instead of sending answers to messages they have already moved past
+    hold_replies=True,
+)
+QUEUE_RETRY_AFTER = os.getenv("INBOUND_RETRY_AFTER_SECONDS", "30")
 
-    except Exception as e:
-        # Log the error; avoid crashing the event loop
-        logger.exception("Error processing message for %s", user_number)
 
+@router.get("/metrics")
+async def whatsapp_metrics():
+    """Backpressure metrics: inbound queue and the bot's OpenAI governor."""
+    return {
+        "inbound": await INBOUND_QUEUE.snapshot(),
+        "duplicate_deliveries": MESSAGE_DEDUPER.duplicates,
+        "openai": OPENAI_GOVERNOR.snapshot(),
+        "outbound": TWILIO_SENDER.snapshot(),
+    }